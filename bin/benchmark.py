@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import resource
+import time
+
+import numpy
+from pyzipcode import ZipCodeDatabase
+
+import miner
+import preprocess
+
+# Transactions of the full_2000, full_2001 and full_2002 datasets: 90%, 7%
+# and 3% of the MovieLens 1M ratings
+MINER_DATASETS = [('full_2000', 900000), ('full_2001', 70000),
+  ('full_2002', 30000)]
+# Values of every field of a full_200x transaction and their count
+MINER_FIELDS = [('name', 3700, 1), ('director', 2000, 1), ('ageCat', 7, 1),
+  ('prof', 21, 1), ('citi', 3000, 1), ('state', 50, 1), ('sex', 2, 1),
+  ('rating', 3, 1), ('actor', 10000, 5), ('genre', 18, 2)]
+
+# Ratings, movies and users of the synthetic datasets, shaped like the
+# MovieLens 1M, 10M and 20M+ releases
+SCALES = {
+    '1m': (1000000, 3900, 6040),
+    '10m': (10000000, 10700, 71600),
+    '100m': (100000000, 27000, 283000),
+    }
+GENRES = ['Action', 'Adventure', 'Animation', "Children's", 'Comedy',
+  'Crime', 'Documentary', 'Drama', 'Fantasy', 'Film-Noir', 'Horror',
+  'Musical', 'Mystery', 'Romance', 'Sci-Fi', 'Thriller', 'War', 'Western']
+AGES = [1, 18, 25, 35, 45, 50, 56]
+AGE_WEIGHTS = [0.04, 0.18, 0.35, 0.20, 0.09, 0.08, 0.06]
+# Share of the 1 to 5 star ratings in MovieLens
+RATING_WEIGHTS = [0.06, 0.11, 0.26, 0.35, 0.22]
+# The ratings span the MovieLens 1M period, most of them in 2000
+FIRST_TIMESTAMP = 956703932
+LAST_TIMESTAMP = 1046454590
+# Share of the movies not found in IMDB and of the invalid postcodes
+MISSING_MOVIES = 0.05
+INVALID_POSTCODES = 0.02
+# Ratings generated and written at once
+GENERATE_CHUNK = 1000000
+# Stages faster than this are not checked against the baseline
+MIN_STAGE_TIME = 0.05
+
+
+def parse_arguments():
+    """ Function that parse main command line parameters
+
+    Returns:
+        * ok: argparse object
+        * fail: argparse will exit
+    """
+    argParser = argparse.ArgumentParser(
+        description='Benchmarks for the Movie Analysis preprocess tool')
+    subParsers = argParser.add_subparsers(dest='benchmark')
+
+    parserArgs = subParsers.add_parser('parser',
+        help='Compare the bulk rating parser with the line generator')
+    parserArgs.add_argument('rating', help='Rating file (ratings.txt or csv)')
+    parserArgs.add_argument('--repeat', type=int, default=3,
+        help='Number of runs, the best one is reported')
+
+    minerArgs = subParsers.add_parser('miner',
+        help='Time the in-process miner with the full_200x dataset sizes')
+    minerArgs.add_argument('--minsup', type=float, nargs='+',
+        default=[0.05, 0.01], help='Minimum supports to benchmark')
+    minerArgs.add_argument('--minconf', type=float, default=0.1)
+    minerArgs.add_argument('--seed', type=int, default=0)
+
+    generateArgs = subParsers.add_parser('generate',
+        help='Write synthetic MovieLens files and a fake IMDB cache')
+    generateArgs.add_argument('directory', help='Output directory')
+    generateArgs.add_argument('--scale', choices=sorted(SCALES),
+        default='1m', help='Number of ratings')
+    generateArgs.add_argument('--seed', type=int, default=0)
+
+    pipelineArgs = subParsers.add_parser('pipeline',
+        help='Time every stage of preprocess over generated files')
+    pipelineArgs.add_argument('directory', help='Directory of generate')
+    pipelineArgs.add_argument('--baseline',
+        help='Results of a previous run to compare with')
+    pipelineArgs.add_argument('--save', help='Write the results to a file')
+    pipelineArgs.add_argument('--tolerance', type=float, default=0.2,
+        help='Slowdown over the baseline reported as a regression')
+
+    args = argParser.parse_args()
+
+    return args
+
+
+def legacy_parse_ratings(filename):
+    """Parse a ratings file line by line with read_csv_from_file
+
+    This is how load_rating used to read the ratings before the bulk parser.
+    """
+    userids = []
+    movieids = []
+    ratings = []
+    timestamps = []
+    for line in preprocess.read_csv_from_file(filename, sep='::'):
+        if len(line) == 1:
+            # csv layout, the first line is the header
+            line = line[0].split(',')
+            if not line[0].isdigit():
+                continue
+        (userid, movieid, rating, timestamp) = line
+        userids.append(int(userid))
+        movieids.append(int(movieid))
+        ratings.append(float(rating))
+        timestamps.append(int(timestamp))
+
+    return userids, movieids, ratings, timestamps
+
+
+def best_time(repeat, function, *args):
+    """Return the best wall time of several runs and the last result"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, result
+
+
+def parser_benchmark(filename, repeat):
+    """Time the line generator and the bulk parser over the same file"""
+    legacyTime, columns = best_time(repeat, legacy_parse_ratings, filename)
+    rows = len(columns[0])
+    bulkTime, columns = best_time(repeat, preprocess.parse_ratings, filename)
+    if len(columns[0]) != rows:
+        print("Error: the parsers read a different number of ratings")
+        return 1
+
+    print("ratings: %d" % rows)
+    print("line generator: %8.3fs %12.0f ratings/s" %
+      (legacyTime, rows / max(legacyTime, 1e-9)))
+    print("bulk parser:    %8.3fs %12.0f ratings/s" %
+      (bulkTime, rows / max(bulkTime, 1e-9)))
+    print("speedup: %.1fx" % (legacyTime / max(bulkTime, 1e-9)))
+
+    return 0
+
+
+def synthetic_transactions(ntrans, seed=0):
+    """Return a TransactionSet shaped like the full_200x datasets
+
+    Every field takes Zipf distributed values, so a few items are very
+    frequent and most of them are rare, as actors and cities are.
+    """
+    random = numpy.random.RandomState(seed)
+    columns = []
+    base = 0
+    for (name, nvalues, count) in MINER_FIELDS:
+        for i in range(count):
+            values = (random.zipf(1.3, ntrans) - 1) % nvalues
+            columns.append(base + values)
+        base += nvalues
+    items = numpy.vstack(columns).T.ravel()
+    transactions = miner.TransactionSet()
+    transactions.extend(items, numpy.full(ntrans, len(columns)))
+    return transactions
+
+
+def miner_benchmark(minsups, minconf, seed):
+    """Time the miner over synthetic datasets of the full_200x sizes"""
+    for (name, ntrans) in MINER_DATASETS:
+        transactions = synthetic_transactions(ntrans, seed)
+        for minsup in minsups:
+            start = time.time()
+            itemsets = miner.frequent_itemsets(transactions, minsup)
+            itemsetsTime = time.time() - start
+            rules = miner.generate_rules(itemsets, len(transactions), minconf)
+            rulesTime = time.time() - start - itemsetsTime
+            print("%-10s %7d transactions minsup %.3f: %6d itemsets %8.3fs,"
+              " %6d rules %8.3fs" % (name, ntrans, minsup, len(itemsets),
+              itemsetsTime, len(rules), rulesTime))
+
+    return 0
+
+
+def _skewed_weights(random, n, exponent):
+    """Return power law weights of n elements, in random order"""
+    weights = 1.0 / numpy.arange(1, n + 1) ** exponent
+    random.shuffle(weights)
+    return weights / weights.sum()
+
+
+def _zipcodes():
+    """Return the zip codes of the zip code database"""
+    rows = ZipCodeDatabase().conn_manager.query('SELECT zip FROM ZipCodes', ())
+    return [str(row[0]) for row in rows]
+
+
+def generate_movies(filename, nmovies, random):
+    """Write a movies.txt file, return the release year of every movie"""
+    years = numpy.clip(2014 - random.exponential(15, nmovies).astype(int),
+      1920, 2014)
+    fh = open(filename, 'w')
+    try:
+        for movieid, year in enumerate(years.tolist(), 1):
+            genres = random.choice(len(GENRES), random.randint(1, 4),
+              replace=False)
+            fh.write('%d::Movie %d (%d)::%s\n' % (movieid, movieid, year,
+              '|'.join(GENRES[genre] for genre in sorted(genres))))
+    finally:
+        fh.close()
+    return years
+
+
+def generate_users(filename, nusers, random):
+    """Write a users.txt file with real and a few invalid zip codes"""
+    zipcodes = _zipcodes()
+    sexes = numpy.where(random.rand(nusers) < 0.72, 'M', 'F')
+    ages = random.choice(AGES, nusers, p=AGE_WEIGHTS)
+    occupations = random.randint(0, 21, nusers)
+    # Users concentrate in a few zip codes, as in cities
+    zipWeights = _skewed_weights(random, len(zipcodes), 1.0)
+    postcodes = [zipcodes[i] for i in
+      random.choice(len(zipcodes), nusers, p=zipWeights)]
+    for i in numpy.flatnonzero(random.rand(nusers) < INVALID_POSTCODES):
+        postcodes[i] = 'T%dA %dB%d' % tuple(random.randint(0, 10, 3))
+    fh = open(filename, 'w')
+    try:
+        for userid in range(nusers):
+            fh.write('%d::%s::%d::%d::%s\n' % (userid + 1, sexes[userid],
+              ages[userid], occupations[userid], postcodes[userid]))
+    finally:
+        fh.close()
+
+
+def generate_ratings(filename, nratings, nmovies, nusers, random):
+    """Write a ratings.txt file
+
+    A few movies get most of the ratings and the user activity is long
+    tailed, as in MovieLens. The activity decays after the first months.
+    """
+    movieWeights = _skewed_weights(random, nmovies, 0.9)
+    userWeights = random.lognormal(0, 1.2, nusers)
+    userWeights /= userWeights.sum()
+    span = LAST_TIMESTAMP - FIRST_TIMESTAMP
+    fh = open(filename, 'w')
+    try:
+        for start in range(0, nratings, GENERATE_CHUNK):
+            size = min(GENERATE_CHUNK, nratings - start)
+            userids = random.choice(nusers, size, p=userWeights) + 1
+            movieids = random.choice(nmovies, size, p=movieWeights) + 1
+            ratings = random.choice(5, size, p=RATING_WEIGHTS) + 1
+            offsets = random.exponential(span / 8.0, size) % span
+            timestamps = FIRST_TIMESTAMP + offsets.astype(numpy.int64)
+            lines = zip(userids.tolist(), movieids.tolist(), ratings.tolist(),
+              timestamps.tolist())
+            fh.write(''.join(['%d::%d::%d::%d\n' % line for line in lines]))
+    finally:
+        fh.close()
+
+
+def generate_imdb_cache(filename, years, random):
+    """Write an IMDB cache with an entry for every movie
+
+    Directors and actors are drawn from pools with a few prolific names.
+    """
+    nmovies = len(years)
+    directorWeights = _skewed_weights(random, max(1, nmovies // 3), 0.8)
+    actorWeights = _skewed_weights(random, nmovies * 3, 0.8)
+    directors = random.choice(len(directorWeights), nmovies, p=directorWeights)
+    actors = random.choice(len(actorWeights), (nmovies, preprocess.CAST_SIZE),
+      p=actorWeights)
+    imdbRatings = numpy.round(random.normal(6.5, 1.2, nmovies).clip(1, 10), 1)
+    missing = random.rand(nmovies) < MISSING_MOVIES
+
+    if os.path.exists(filename):
+        os.remove(filename)
+    cache = preprocess.ImdbCache(filename)
+    for i in range(nmovies):
+        movieid = str(i + 1)
+        if missing[i]:
+            cache[movieid] = preprocess.ImdbEntry(None, None, None, None, None)
+            continue
+        cache[movieid] = preprocess.ImdbEntry(u'Movie %d' % (i + 1),
+          int(years[i]), u'Director %d' % directors[i],
+          [u'Actor %d' % actor for actor in actors[i].tolist()],
+          float(imdbRatings[i]))
+    cache.compact()
+
+
+def write_config(directory):
+    """Write the preprocess config of the generated files
+
+    The datasets are the full_200x datasets of config/preprocess.yaml.
+    """
+    user = ['ageCat', 'profession', 'citi', 'state', 'sex']
+    datasets = {}
+    for (name, years) in [('full_2000', [2000]), ('full_2001', [2001]),
+      ('full_2002', {'from': 2002, 'to': 2014})]:
+        datasets[name] = {'head': ['name', 'director'], 'user': list(user),
+          'tail': ['cast', 'genre'], 'years': years}
+    config = {'benchmark': {
+        'input': {'base_path': directory, 'movie': 'movies.txt',
+          'user': 'users.txt', 'rating': 'ratings.txt'},
+        'output': {'base_path': os.path.join(directory, 'output'),
+          'imdb': '../imdb_cache.jsonl', 'format': 'labels'},
+        'datasets': datasets,
+        }}
+    fh = open(os.path.join(directory, 'benchmark.yaml'), 'w')
+    try:
+        preprocess.yaml.safe_dump(config, fh, default_flow_style=False)
+    finally:
+        fh.close()
+
+
+def generate(directory, scale, seed):
+    """Write the synthetic input files, IMDB cache and config of a scale"""
+    (nratings, nmovies, nusers) = SCALES[scale]
+    random = numpy.random.RandomState(seed)
+    directory = os.path.abspath(directory)
+    if not os.path.isdir(os.path.join(directory, 'output')):
+        os.makedirs(os.path.join(directory, 'output'))
+
+    start = time.time()
+    years = generate_movies(os.path.join(directory, 'movies.txt'), nmovies,
+      random)
+    generate_users(os.path.join(directory, 'users.txt'), nusers, random)
+    generate_imdb_cache(os.path.join(directory, 'imdb_cache.jsonl'), years,
+      random)
+    generate_ratings(os.path.join(directory, 'ratings.txt'), nratings, nmovies,
+      nusers, random)
+    write_config(directory)
+    print("%d ratings, %d movies and %d users written to %s in %.1fs" %
+      (nratings, nmovies, nusers, directory, time.time() - start))
+
+    return 0
+
+
+def peak_rss():
+    """Return the peak resident memory of the process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class StageTimer:
+    """Time the stages of a run and record their throughput and peak RSS"""
+
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, function, *args, **kwargs):
+        """Run a stage and return its result
+
+        The rows keyword is a function that returns the number of rows
+        processed by the stage given its result.
+        """
+        rows = kwargs.pop('rows', None)
+        start = time.time()
+        result = function(*args, **kwargs)
+        elapsed = time.time() - start
+        if rows is not None:
+            rows = rows(result)
+        self.stages.append({
+            'stage': name,
+            'seconds': elapsed,
+            'rows': rows,
+            'throughput': rows / max(elapsed, 1e-9) if rows else None,
+            'peakRss': peak_rss(),
+            })
+        print("%-28s %9.3fs %12s %14s %9.1f MB" % (name, elapsed,
+          rows if rows is not None else '',
+          '%.0f rows/s' % self.stages[-1]['throughput'] if rows else '',
+          self.stages[-1]['peakRss']))
+        return result
+
+
+def _write_dataset(output, moviesDict, usersDict):
+    preprocess.write_transactions([output], moviesDict, usersDict)
+    return output
+
+
+def pipeline_benchmark(directory, baseline=None, save=None, tolerance=0.2):
+    """Time every stage of preprocess over the generate files"""
+    config = preprocess.readYaml(os.path.join(directory, 'benchmark.yaml'))
+    if not config:
+        print("Error loading %s, run the generate benchmark first" %
+          os.path.join(directory, 'benchmark.yaml'))
+        return 1
+    config = config['benchmark']
+    inputPath = config['input']['base_path']
+    outputPath = config['output']['base_path']
+
+    timer = StageTimer()
+    moviesDict = timer.run('load_movies', preprocess.load_movies,
+      os.path.join(inputPath, config['input']['movie']), rows=len)
+    timer.run('get_extra_info_from_movies',
+      preprocess.get_extra_info_from_movies, moviesDict,
+      os.path.join(outputPath, config['output']['imdb']),
+      rows=lambda result: len(moviesDict))
+    usersDict = timer.run('load_users', preprocess.load_users,
+      os.path.join(inputPath, config['input']['user']), rows=len)
+    timer.run('resolve_user_cities', preprocess.resolve_user_cities,
+      usersDict, preprocess.PostcodeResolver(),
+      rows=lambda result: len(usersDict))
+    ratingStore = timer.run('load_rating', preprocess.load_rating,
+      os.path.join(inputPath, config['input']['rating']), rows=len)
+    timer.run('assign_rating', preprocess.assign_rating, ratingStore,
+      moviesDict, usersDict, rows=lambda result: len(ratingStore))
+    outputs = preprocess.dataset_outputs(config['datasets'], outputPath,
+      config['output'].get('format', 'labels'))
+    for output in outputs:
+        name = os.path.splitext(os.path.basename(output.filename))[0]
+        timer.run('write ' + name, _write_dataset, output, moviesDict,
+          usersDict, rows=lambda output: output.transid)
+
+    results = {'ratings': len(ratingStore), 'movies': len(moviesDict),
+      'users': len(usersDict), 'stages': timer.stages}
+    if save:
+        fh = open(save, 'w')
+        try:
+            json.dump(results, fh, indent=1, sort_keys=True)
+        finally:
+            fh.close()
+    if baseline:
+        return compare_baseline(results, baseline, tolerance)
+
+    return 0
+
+
+def compare_baseline(results, filename, tolerance):
+    """Compare the stage times with a baseline, return 1 on regressions"""
+    fh = open(filename, 'r')
+    try:
+        baseline = json.load(fh)
+    finally:
+        fh.close()
+    if baseline['ratings'] != results['ratings']:
+        print("Warning: the baseline has %d ratings, this run %d" %
+          (baseline['ratings'], results['ratings']))
+
+    previous = dict((stage['stage'], stage) for stage in baseline['stages'])
+    regressions = 0
+    for stage in results['stages']:
+        old = previous.get(stage['stage'])
+        if old is None:
+            continue
+        ratio = stage['seconds'] / max(old['seconds'], 1e-9)
+        regression = ratio > 1 + tolerance and \
+          stage['seconds'] > MIN_STAGE_TIME
+        regressions += regression
+        print("%-28s %9.3fs -> %9.3fs %6.2fx%s" % (stage['stage'],
+          old['seconds'], stage['seconds'], ratio,
+          ' REGRESSION' if regression else ''))
+
+    if regressions:
+        print("%d stages slower than the baseline" % regressions)
+        return 1
+    return 0
+
+
+def main():
+    cmdArgs = parse_arguments()
+
+    if cmdArgs.benchmark == 'parser':
+        return parser_benchmark(cmdArgs.rating, cmdArgs.repeat)
+    if cmdArgs.benchmark == 'miner':
+        return miner_benchmark(cmdArgs.minsup, cmdArgs.minconf, cmdArgs.seed)
+    if cmdArgs.benchmark == 'generate':
+        return generate(cmdArgs.directory, cmdArgs.scale, cmdArgs.seed)
+    if cmdArgs.benchmark == 'pipeline':
+        return pipeline_benchmark(cmdArgs.directory, cmdArgs.baseline,
+          cmdArgs.save, cmdArgs.tolerance)
+
+    return 1
+
+
+if __name__ == "__main__":
+    exit(main())
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+import argparse
+import os
+import shelve
+
+import preprocess
+
+
+class Movie:
+    """Movie class of the old shelve cache
+
+    The shelve pickled whole __main__.Movie objects, this class lets pickle
+    load them without the current Movie implementation.
+    """
+
+
+class Rating:
+    """Rating class of the old shelve cache"""
+
+
+def shelve_size(filename):
+    """Return the size of a shelve, whose dbm may use several files"""
+    size = 0
+    for suffix in ('', '.db', '.dat', '.dir', '.bak'):
+        if os.path.isfile(filename + suffix):
+            size += os.path.getsize(filename + suffix)
+    return size
+
+
+def parse_arguments():
+    """ Function that parse main command line parameters
+
+    Returns:
+        * ok: argparse object
+        * fail: argparse will exit
+    """
+    argParser = argparse.ArgumentParser(
+        description='Convert the shelve IMDB cache to the new cache format')
+    argParser.add_argument('shelve', help='Old shelve cache file')
+    argParser.add_argument('cache', help='New cache file')
+
+    args = argParser.parse_args()
+
+    return args
+
+
+def main():
+    cmdArgs = parse_arguments()
+
+    try:
+        oldCache = shelve.open(cmdArgs.shelve, 'r')
+    except Exception as e:
+        print("Error opening the shelve cache %s: %s" % (cmdArgs.shelve, e))
+        return 1
+
+    cache = preprocess.ImdbCache(cmdArgs.cache)
+    for movieid in oldCache.keys():
+        movie = oldCache[movieid]
+        cache[movieid] = preprocess.ImdbEntry(
+          getattr(movie, 'name', None),
+          getattr(movie, 'year', None),
+          getattr(movie, 'director', None),
+          getattr(movie, 'cast', None),
+          getattr(movie, 'imdbRating', None))
+    oldCache.close()
+    cache.compact()
+
+    print("%d movies migrated" % len(cache))
+    print("cache size: %d bytes (shelve: %d bytes)" %
+      (os.path.getsize(cmdArgs.cache), shelve_size(cmdArgs.shelve)))
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,198 @@
+"""Frequent itemsets and association rules over in-memory transactions
+
+The miner is a bitset based Eclat built on NumPy: every frequent item keeps
+a packed bitset of the transactions that contain it, and the support of an
+itemset is the popcount of the AND of its items bitsets.
+"""
+import array
+
+import numpy
+
+# Default maximum itemset length, as in arules
+MAXLEN = 10
+# Number of set bits of every 16 bits word
+_POPCOUNT = numpy.array([bin(i).count('1') for i in range(1 << 16)],
+  dtype=numpy.uint8)
+
+
+class TransactionSet:
+    """Transactions of item ids, stored as a flat array with offsets
+
+    Items repeated inside a transaction are counted once.
+    """
+
+    def __init__(self):
+        self.items = array.array('i')
+        self.offsets = array.array('l', [0])
+
+    def add(self, items):
+        """Add a transaction given its item ids"""
+        self.items.extend(items)
+        self.offsets.append(len(self.items))
+
+    def extend(self, items, lengths):
+        """Add several transactions given their concatenated item ids and
+        their lengths"""
+        offsets = numpy.cumsum(lengths, dtype=numpy.int64) + self.offsets[-1]
+        self.items.extend(numpy.asarray(items, dtype=numpy.int32).tolist())
+        self.offsets.extend(offsets.tolist())
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def pairs(self):
+        """Return the distinct (tid, item) pairs as two arrays"""
+        if not len(self.items):
+            return (numpy.zeros(0, dtype=numpy.int64),
+              numpy.zeros(0, dtype=numpy.int32))
+        items = numpy.frombuffer(self.items, dtype=numpy.int32)
+        offsets = numpy.frombuffer(self.offsets,
+          dtype='i%d' % self.offsets.itemsize)
+        tids = numpy.repeat(numpy.arange(len(self), dtype=numpy.int64),
+          numpy.diff(offsets))
+        width = int(items.max()) + 1
+        key = numpy.unique(tids * width + items)
+        return key // width, (key % width).astype(numpy.int32)
+
+    def matrix(self):
+        """Return the transaction x item incidence matrix in CSR form
+
+        Returns (indptr, indices, columns): the columns are the sorted
+        distinct item ids, and the row i has the columns
+        indices[indptr[i]:indptr[i + 1]].
+        """
+        (tids, items) = self.pairs()
+        columns = numpy.unique(items)
+        indices = numpy.searchsorted(columns, items).astype(numpy.int32)
+        indptr = numpy.zeros(len(self) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(tids, minlength=len(self)),
+          out=indptr[1:])
+        return indptr, indices, columns
+
+
+def _popcount(bitsets):
+    """Return the number of set bits of every row of a bitsets matrix"""
+    return _POPCOUNT[bitsets.view(numpy.uint16)].sum(axis=1,
+      dtype=numpy.int64)
+
+
+def _bitset(tids, nbytes):
+    """Return the packed bitset of a list of transaction ids"""
+    bits = numpy.zeros(nbytes * 8, dtype=bool)
+    bits[tids] = True
+    return numpy.packbits(bits)
+
+
+def frequent_itemsets(transactions, minsup, maxlen=MAXLEN):
+    """Return the frequent itemsets of a TransactionSet
+
+    minsup is the relative minimum support. Returns a dictionary of
+    itemset (sorted tuple of item ids) -> number of transactions.
+    """
+    ntrans = len(transactions)
+    if not ntrans:
+        return {}
+    minCount = max(1, int(numpy.ceil(minsup * ntrans - 1e-9)))
+
+    (tids, items) = transactions.pairs()
+    counts = numpy.bincount(items)
+    frequent = numpy.flatnonzero(counts >= minCount)
+
+    # Bitsets of the frequent items, padded to whole 16 bits words
+    nbytes = (ntrans + 15) // 16 * 2
+    keep = counts[items] >= minCount
+    tids = tids[keep]
+    items = items[keep]
+    order = numpy.argsort(items)
+    tids = tids[order]
+    items = items[order]
+    starts = numpy.searchsorted(items, frequent, side='left')
+    stops = numpy.searchsorted(items, frequent, side='right')
+    bitsets = numpy.vstack([_bitset(tids[start:stop], nbytes)
+      for start, stop in zip(starts, stops)]) if len(frequent) else None
+
+    itemsets = {}
+    for item, count in zip(frequent.tolist(), counts[frequent].tolist()):
+        itemsets[(item,)] = count
+    if maxlen > 1 and len(frequent) > 1:
+        _eclat((), frequent.tolist(), bitsets, minCount, maxlen, itemsets)
+
+    return itemsets
+
+
+def _eclat(prefix, items, bitsets, minCount, maxlen, itemsets):
+    """Depth first extension of the itemsets starting with prefix
+
+    items are the frequent extensions of prefix, sorted, and bitsets their
+    bitsets already ANDed with the prefix bitset.
+    """
+    for i in range(len(items) - 1):
+        itemset = prefix + (items[i],)
+        # AND the bitset of the item with all the following ones at once
+        joined = numpy.bitwise_and(bitsets[i + 1:], bitsets[i])
+        counts = _popcount(joined)
+        keep = numpy.flatnonzero(counts >= minCount)
+        if not len(keep):
+            continue
+        extensions = [items[i + 1 + k] for k in keep.tolist()]
+        for item, count in zip(extensions, counts[keep].tolist()):
+            itemsets[itemset + (item,)] = count
+        if len(itemset) + 1 < maxlen and len(extensions) > 1:
+            _eclat(itemset, extensions, joined[keep], minCount, maxlen,
+              itemsets)
+
+
+def generate_rules(itemsets, ntrans, minconf, minlift=None):
+    """Return the rules lhs => rhs of the frequent itemsets
+
+    As arules, rules have a single item rhs and a non empty lhs. Returns a
+    list of (lhs, rhs, support, confidence, lift) sorted by lift.
+    """
+    rules = []
+    for itemset, count in itemsets.items():
+        if len(itemset) < 2:
+            continue
+        for rhs in itemset:
+            lhs = tuple(item for item in itemset if item != rhs)
+            confidence = float(count) / itemsets[lhs]
+            if confidence < minconf:
+                continue
+            lift = confidence * ntrans / itemsets[(rhs,)]
+            if minlift is not None and lift < minlift:
+                continue
+            rules.append((lhs, rhs, float(count) / ntrans, confidence, lift))
+
+    rules.sort(key=lambda rule: (-rule[4], -rule[2], rule[0], rule[1]))
+    return rules
+
+
+def mine_rules(transactions, minsup, minconf, minlift=None, maxlen=MAXLEN):
+    """Return the rules of a TransactionSet, see generate_rules"""
+    itemsets = frequent_itemsets(transactions, minsup, maxlen)
+    return generate_rules(itemsets, len(transactions), minconf, minlift)
+
+
+def format_rule(rule, labels):
+    """Return a rule as the "{a,b} => {c}" string of arules"""
+    (lhs, rhs, support, confidence, lift) = rule
+    return u'{%s} => {%s}' % (u','.join(labels[item] for item in lhs),
+      labels[rhs])
+
+
+def write_rules(filename, rules, labels):
+    """Write the rules in the csv format of the arules write function
+
+    labels maps the item ids to their labels.
+    """
+    fh = open(filename, 'w')
+    try:
+        fh.write('"rules","support","confidence","lift"\n')
+        for rule in rules:
+            line = u'"%s",%.6f,%.6f,%.6f\n' % ((format_rule(rule, labels),) +
+              tuple(rule[2:]))
+            fh.write(line.encode('utf-8'))
+    finally:
+        fh.close()
+
+
+# vim: set expandtab ts=4 sw=4:
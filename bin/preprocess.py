@@ -4,8 +4,40 @@ import imdb
 from pyzipcode import ZipCodeDatabase
 import yaml
 import re
+import string
 import datetime
-import shelve
+import time
+import os
+import sys
+import subprocess
+import errno
+import fcntl
+import json
+import hashlib
+import collections
+import threading
+import Queue
+import contextlib
+import multiprocessing
+import resource
+import cProfile
+import pstats
+import gzip
+import unicodedata
+import numpy
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+import miner
 
 professions = {
     '0': 'unknown',
@@ -33,10 +65,187 @@ professions = {
     }
 CAST_SIZE = 5 
 GENRE_SIZE = 3
+RATING_CATS = ('low', 'medium', 'high')
+BLOCK_SIZE = 16 * 1024 * 1024
+# Movies queried to IMDB between two syncs of the cache
+CHECKPOINT_SIZE = 20
+# Postcodes per zip code database query
+QUERY_BATCH_SIZE = 500
+# Bytes hashed at the start and at the end of a file to fingerprint it
+FINGERPRINT_SAMPLE = 1024 * 1024
+# Bytes of rows handed at once to the writer thread of an output, and
+# buffers waiting to be written
+SINK_BUFFER = 1024 * 1024
+SINK_QUEUE = 8
+# Level of the gzip outputs, the default of gzip(1): level 9 is three times
+# slower for a 2% smaller file
+GZIP_LEVEL = 6
+# Magic numbers of the compressed files and their suffix
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'xz': '.xz'}
+# Layout version of the snapshot files, see Snapshot
+SNAPSHOT_VERSION = 1
+# Shards of movies per process of a parallel run, to balance the load
+SHARDS_PER_WORKER = 4
+# Tags tracked per movie while the tags file is read, see TagCounter
+TAG_CAPACITY = 256
+# Default thresholds of the rules mined in process
+MINSUP = 0.01
+MINCONF = 0.1
+_POSTCODE_SUFFIX = re.compile(r'-\d*')
+_ZIPCODE = re.compile(r'^[0-9]{5}$')
+# Field separators of the rating files, translated to blanks before parsing
+_SEPARATORS = string.maketrans(b':,', b'  ')
+_DECIMAL_SEPARATORS = string.maketrans(b':,.', b'   ')
+_LONG_DECIMAL = re.compile(br'\.[0-9][0-9]')
+_TAG_SPACES = re.compile(r'\s+', re.UNICODE)
+_TAG_STRIP = u' \'.,;:!?'
+# Kinds of IMDB titles matched by the dumps enrichment, by preference
+IMDB_TITLE_TYPES = {'movie': 0, 'tvMovie': 1, 'video': 2, 'tvSpecial': 3,
+  'tvMiniSeries': 4, 'short': 5}
+# Principals of a title that make up its cast
+IMDB_CAST_CATEGORIES = ('actor', 'actress', 'self')
+# MovieLens names: "Title, The (Alternate title) (1995)"
+_TITLE_YEAR = re.compile(r'^(.*?)\s*\((\d{4})\)\s*$')
+_TITLE_ALTERNATE = re.compile(r'^(.+?)\s*\((?:a\.k\.a\. )?([^()]+)\)$')
+_TITLE_ARTICLE = re.compile(r"^(.+), (the|an?|l'|les?|la|los|las|el|il|"
+  r"lo|gli|i|das|der|die|den|une?|una?)$", re.IGNORECASE | re.UNICODE)
+_TITLE_SYMBOLS = re.compile(r'[\W_]+', re.UNICODE)
+
+
+class Metrics:
+    """Stage timers and counters of a run
+
+    Every stage records its wall time and the peak memory of the process
+    at its end: the peak RSS and, when tracing is enabled and tracemalloc
+    is available (Python 3), the peak of the traced allocations during
+    the stage. Counters are safe to update from several threads.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.counters = collections.defaultdict(int)
+        self.outputs = {}
+        self.lock = threading.Lock()
+        self.traceMemory = False
+
+    def startTracing(self):
+        """Sample the peak memory of every stage with tracemalloc"""
+        if tracemalloc is None:
+            print("Warning: tracemalloc is not available, only the peak RSS "
+              "is reported")
+            return
+        tracemalloc.start()
+        self.traceMemory = True
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the code run inside a with block"""
+        if self.traceMemory:
+            tracemalloc.clear_traces()
+        start = time.time()
+        try:
+            yield
+        finally:
+            entry = {
+                'stage': name,
+                'seconds': time.time() - start,
+                'peakRss': resource.getrusage(
+                  resource.RUSAGE_SELF).ru_maxrss * 1024,
+                }
+            if self.traceMemory:
+                entry['tracedPeak'] = tracemalloc.get_traced_memory()[1]
+            self.stages.append(entry)
+
+    def count(self, name, value=1):
+        """Add value to a counter"""
+        with self.lock:
+            self.counters[name] += value
+
+    def output(self, filename, transactions, items, rows=0, size=0):
+        """Record the transactions, items, rows and bytes written to an
+        output"""
+        self.outputs[filename] = {'transactions': transactions,
+          'items': items, 'rows': rows, 'bytes': size}
+
+    def report(self):
+        """Return all the metrics as a dictionary"""
+        return {
+            'stages': self.stages,
+            'counters': dict(self.counters),
+            'outputs': self.outputs,
+            }
+
+    def write(self, filename):
+        """Write the metrics as a JSON file"""
+        fh = open(filename, 'w')
+        try:
+            json.dump(self.report(), fh, indent=1, sort_keys=True)
+        finally:
+            fh.close()
+
+
+# Metrics of the current run
+metrics = Metrics()
+
+
+class Categorical(object):
+    """Attribute stored as a small integer code into a shared dictionary
+
+    The descriptor keeps one copy of every distinct value for all the
+    instances of a class, which only store the code in the slot. Reading
+    the attribute returns the value, as a plain attribute would.
+    """
 
-class Movie:
+    def __init__(self, slot, values=()):
+        self.slot = slot
+        self.values = list(values)
+        self.codes = dict((value, code) for code, value in
+          enumerate(self.values))
+
+    def code(self, value):
+        """Return the code of a value, adding it if it is new"""
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        return self.values[getattr(obj, self.slot)]
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, self.code(value))
+
+
+class CategoricalList(Categorical):
+    """List attribute whose items are coded by a shared dictionary"""
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        codes = getattr(obj, self.slot)
+        if codes is None:
+            return None
+        return [self.values[code] for code in codes]
+
+    def __set__(self, obj, values):
+        if values is not None:
+            values = tuple([self.code(value) for value in values])
+        setattr(obj, self.slot, values)
+
+
+class Movie(object):
     """ Class that represents a movie"""
 
+    __slots__ = ('id', 'name', 'imdbName', 'year', '_yearCat', 'director',
+      'cast', '_genre', 'imdbRating', 'rating', 'tags')
+    yearCat = Categorical('_yearCat')
+    genre = CategoricalList('_genre')
+
     def __init__(self):
         """Default constructo """
 
@@ -50,31 +259,34 @@ class Movie:
         self.genre = None
         self.imdbRating = None
         self.rating = []
+        self.tags = None
 
 
-    def getExtraInfo(self, cache):
+    def getExtraInfo(self, cache, imdbObj=None, request=None):
         """Load imdb information from file or IMDB server
 
         The function will try to read movie info from a text cache file. If 
         the movie ain't there, it will query IMDB server and store the output
-        in the cache
+        in the cache. imdbObj and request are passed to _queryImdb.
         """
-        if cache.has_key(self.id):
-            self.name = cache[self.id].name
-            self.imdbName = cache[self.id].imdbName
-            self.year = cache[self.id].year
-            self.director = cache[self.id].director
-            self.cast = cache[self.id].cast
-            self.genre = cache[self.id].genre
-            self.imdbRating = cache[self.id].imdbRating
-            self.rating = cache[self.id].rating
+        if self.id in cache:
+            metrics.count('imdb.cacheHits')
+            (self.name, self.year, self.director, self.cast,
+              self.imdbRating) = cache[self.id]
         else:
-            self._queryImdb()
-            cache[self.id] = self
+            metrics.count('imdb.cacheMisses')
+            self._queryImdb(imdbObj, request)
+            cache[self.id] = self.cacheEntry()
         
         return
         
 
+    def cacheEntry(self):
+        """Return the IMDB information to be stored in the cache"""
+        return ImdbEntry(self.name, self.year, self.director, self.cast,
+          self.imdbRating)
+
+
     def categorize(self):
         """Categorize some field related to movies"""
         if self.year:
@@ -90,20 +302,28 @@ class Movie:
 #        """
         
 
-    def _queryImdb(self):
-        """Get movie information from IMDB"""
+    def _queryImdb(self, imdbObj=None, request=None):
+        """Get movie information from IMDB
+
+        imdbObj is the IMDb client to use, a new one is created if None.
+        request(function, *args) performs every IMDB round trip, so the
+        caller can add rate limiting and retries.
+        """
 
         #return
-        imdbObj = imdb.IMDb()
+        if imdbObj is None:
+            imdbObj = imdb.IMDb(reraiseExceptions=True)
+        if request is None:
+            request = lambda function, *args: function(*args)
         try:
-            imdbMovieObj = imdbObj.search_movie(self.imdbName)[0]
+            imdbMovieObj = request(imdbObj.search_movie, self.imdbName)[0]
         except IndexError:
             print("Warning: movie %s was not found on IMDB." % self.imdbName)
             return
 
         if imdbMovieObj['long imdb canonical title'] == self.imdbName:
             imdbID = imdbMovieObj.getID()
-            imdbMovieObj = imdbObj.get_movie(imdbID)
+            imdbMovieObj = request(get_imdb_movie, imdbObj, imdbID)
 
             if 'title' in imdbMovieObj.keys():
                 self.name = imdbMovieObj['title']
@@ -115,7 +335,7 @@ class Movie:
             if 'cast' in imdbMovieObj.keys():
                 self.cast = list(map((lambda x: x['name']), imdbMovieObj['cast'][:CAST_SIZE]))
             else:
-                self.Cast = None
+                self.cast = None
             if 'rating' in imdbMovieObj.keys():
                 self.imdbRating = imdbMovieObj['rating']
         else:
@@ -124,9 +344,18 @@ class Movie:
             
 
 
-class User:
+class User(object):
     """User representation class"""
 
+    __slots__ = ('id', '_sex', '_ageCat', '_profession', '_postcode', '_citi',
+      '_state', 'rating')
+    sex = Categorical('_sex')
+    ageCat = Categorical('_ageCat')
+    profession = Categorical('_profession')
+    postcode = Categorical('_postcode')
+    citi = Categorical('_citi')
+    state = Categorical('_state')
+
     def __init__(self):
         self.id = None
         self.sex = None     # male or female
@@ -164,24 +393,145 @@ class User:
         self.profession = professions[professionCode]
         self.postcode = postcode
     
-    def getCiti(self):
-        """ write the city and state given the postcode"""
+    def getCiti(self, resolver=None):
+        """ write the city and state given the postcode
+
+        resolver is the PostcodeResolver to use, by default the one shared
+        by all the users."""
         if self.postcode:
-            zcdb = ZipCodeDatabase()
-            regexp = re.compile(r'-\d*')
-            try:
-                postcode = re.sub(regexp, "", self.postcode)
-                zipcode = zcdb[postcode]
-                self.citi = zipcode.city
-                self.state = zipcode.state
-            except:
-                self.citi = "NA-citi"
-                self.state = "NA-state"
+            if resolver is None:
+                resolver = shared_postcode_resolver()
+            (self.citi, self.state) = resolver.lookup(self.postcode)
             
 
-class Rating:
+class PostcodeResolver:
+    """Resolve postcodes to their city and state
+
+    A single ZipCodeDatabase is shared by all the lookups. Postcodes are
+    normalized (the "-1234" suffix is removed) and deduplicated, and the
+    unknown ones are resolved with batched queries. Results are kept in
+    memory and optionally in a JSON snapshot file.
+    Postcodes missing from the database fall back to the most common city of
+    their ZIP3 prefix; if the prefix is unknown too, they resolve to
+    NA-citi/NA-state.
+    """
+
+    def __init__(self, snapshot=None, zip3Fallback=True):
+        self.snapshot = snapshot
+        self.zip3Fallback = zip3Fallback
+        self.zcdb = None
+        self.table = {}
+        self.fallbacks = 0
+        if snapshot and os.path.isfile(snapshot):
+            fh = open(snapshot, 'r')
+            try:
+                for postcode, location in json.load(fh).items():
+                    self.table[postcode] = tuple(location) if location else None
+            finally:
+                fh.close()
+
+    @staticmethod
+    def normalize(postcode):
+        """Return the 5 digit zip code of a postcode, or None"""
+        postcode = _POSTCODE_SUFFIX.sub("", postcode.strip())
+        return postcode if _ZIPCODE.match(postcode) else None
+
+    def _query(self, sql, params):
+        if self.zcdb is None:
+            self.zcdb = ZipCodeDatabase()
+        rows = []
+        for i in range(0, len(params), QUERY_BATCH_SIZE):
+            batch = params[i:i + QUERY_BATCH_SIZE]
+            marks = ','.join('?' * len(batch))
+            rows.extend(self.zcdb.conn_manager.query(sql % marks, batch))
+        return rows
+
+    def resolve(self, postcodes):
+        """Resolve all the postcodes not resolved yet in a single batch"""
+        missing = set()
+        for postcode in postcodes:
+            zipcode = self.normalize(postcode) if postcode else None
+            if zipcode and zipcode not in self.table:
+                missing.add(zipcode)
+        if not missing:
+            return
+        missing = sorted(missing)
+
+        for (zipcode, city, state) in self._query(
+          "SELECT zip, city, state FROM ZipCodes WHERE zip IN (%s)", missing):
+            self.table[zipcode] = (city, state)
+
+        notFound = [zipcode for zipcode in missing if zipcode not in self.table]
+        prefixes = {}
+        if self.zip3Fallback and notFound:
+            # Keep the most common city of every prefix
+            best = {}
+            for (prefix, city, state, count) in self._query(
+              "SELECT substr(zip, 1, 3), city, state, COUNT(*) FROM ZipCodes "
+              "WHERE substr(zip, 1, 3) IN (%s) GROUP BY 1, 2, 3",
+              sorted(set(zipcode[:3] for zipcode in notFound))):
+                if prefix not in best or count > best[prefix][0] or \
+                  (count == best[prefix][0] and city < best[prefix][1]):
+                    best[prefix] = (count, city, state)
+            prefixes = dict((prefix, (city, state))
+              for prefix, (count, city, state) in best.items())
+
+        for zipcode in notFound:
+            self.table[zipcode] = prefixes.get(zipcode[:3])
+        metrics.count('postcode.queried', len(missing))
+        metrics.count('postcode.zip3Fallbacks', len([zipcode for zipcode in
+          notFound if self.table[zipcode] is not None]))
+
+    def lookup(self, postcode):
+        """Return the (city, state) of a postcode"""
+        zipcode = self.normalize(postcode) if postcode else None
+        if zipcode and zipcode not in self.table:
+            self.resolve([zipcode])
+        location = self.table.get(zipcode) if zipcode else None
+        if location is None:
+            self.fallbacks += 1
+            metrics.count('postcode.naFallbacks')
+            return ("NA-citi", "NA-state")
+        return location
+
+    def save(self):
+        """Write the results table to the snapshot file"""
+        if not self.snapshot:
+            return
+        fh = open(self.snapshot, 'w')
+        try:
+            json.dump(self.table, fh, sort_keys=True)
+        finally:
+            fh.close()
+
+
+_sharedPostcodeResolver = None
+
+def shared_postcode_resolver():
+    """Return the PostcodeResolver shared by default by all the users"""
+    global _sharedPostcodeResolver
+    if _sharedPostcodeResolver is None:
+        _sharedPostcodeResolver = PostcodeResolver()
+    return _sharedPostcodeResolver
+
+
+def resolve_user_cities(usersDict, resolver=None):
+    """Write the city and state of all the users in one batched pass"""
+    if resolver is None:
+        resolver = shared_postcode_resolver()
+    resolver.resolve([user.postcode for user in usersDict.values()])
+    for user in usersDict.values():
+        user.getCiti(resolver)
+    resolver.save()
+
+
+class Rating(object):
     """Rating representation"""
 
+    __slots__ = ('userid', 'movieid', 'rating', '_ratingCat', 'timestamp')
+    # Same codes as the ratingCat column of RatingStore
+    ratingCat = Categorical('_ratingCat', RATING_CATS)
+
     def __init__(self):
         self.userid = None
         self.movieid = None
@@ -191,12 +541,193 @@ class Rating:
 
     def categorize(self):
         if self.rating:
-            rating = int(self.rating)
+            rating = int(float(self.rating))
             if rating<=2: self.ratingCat = 'low'
             if rating==3: self.ratingCat = 'medium'
             if rating>=4: self.ratingCat = 'high'
 
 
+class RatingStore:
+    """Columnar representation of all the ratings
+
+    The ratings are kept as parallel NumPy arrays instead of one Rating
+    object per line:
+     * userid, movieid: int32
+     * rating: float32
+     * timestamp: uint32
+     * ratingCat: int8 code into RATING_CATS
+     * year: int16, local year of the timestamp
+     * month: int8, local month of the timestamp
+    Once assign_rating sorted it, the ratings of every movie are contiguous
+    and ordered by timestamp, so every year, month or date range of a movie
+    is a slice of the store.
+    """
+
+    def __init__(self, userid, movieid, rating, timestamp, ratingCat=None,
+      year=None, month=None):
+        self.userid = numpy.asarray(userid, dtype=numpy.int32)
+        self.movieid = numpy.asarray(movieid, dtype=numpy.int32)
+        self.rating = numpy.asarray(rating, dtype=numpy.float32)
+        self.timestamp = numpy.asarray(timestamp, dtype=numpy.uint32)
+        # The derived columns are only given by a Snapshot
+        if ratingCat is None:
+            ratingCat = categorize_ratings(self.rating)
+            (year, month) = timestamps_to_month(self.timestamp)
+        self.ratingCat = ratingCat
+        (self.year, self.month) = (year, month)
+
+    def __len__(self):
+        return len(self.userid)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.row(i)
+
+    @property
+    def nbytes(self):
+        """Memory used by the columns"""
+        return sum(column.nbytes for column in self._columns())
+
+    # Names of the columns, in the order of the constructor arguments
+    COLUMNS = ('userid', 'movieid', 'rating', 'timestamp', 'ratingCat',
+      'year', 'month')
+
+    def _columns(self):
+        return [getattr(self, name) for name in self.COLUMNS]
+
+    def take(self, order):
+        """Reorder all the columns in place"""
+        (self.userid, self.movieid, self.rating, self.timestamp,
+          self.ratingCat, self.year, self.month) = \
+          [column[order] for column in self._columns()]
+
+    def row(self, i):
+        """Return the i-th rating as a Rating object"""
+        ratingObj = Rating()
+        ratingObj.userid = str(self.userid[i])
+        ratingObj.movieid = str(self.movieid[i])
+        ratingObj.rating = '%g' % self.rating[i]
+        ratingObj.ratingCat = RATING_CATS[self.ratingCat[i]]
+        ratingObj.timestamp = str(self.timestamp[i])
+        return ratingObj
+
+
+class RatingList:
+    """Ratings of one movie or user, as a view over a RatingStore
+
+    index is either a slice or an array of positions in the store. Iterating
+    it returns Rating objects, but the writers use the store columns
+    directly.
+    """
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __len__(self):
+        if isinstance(self.index, slice):
+            return self.index.stop - self.index.start
+        return len(self.index)
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        if isinstance(self.index, slice):
+            positions = xrange(self.index.start, self.index.stop)
+        else:
+            positions = self.index
+        for i in positions:
+            yield self.store.row(i)
+
+    def between(self, bounds):
+        """Return the slices of the store with the ratings inside periods
+
+        bounds are the flattened [start, stop) timestamps of sorted periods,
+        see period_bounds. Only for the ratings of a movie, which are a
+        slice of the store sorted by timestamp.
+        """
+        start = self.index.start
+        timestamp = self.store.timestamp[start:self.index.stop]
+        positions = (numpy.searchsorted(timestamp, bounds) + start).tolist()
+        return [slice(first, last) for first, last in
+          zip(positions[0::2], positions[1::2]) if last > first]
+
+
+def categorize_ratings(rating):
+    """Return the RATING_CATS codes of an array of ratings"""
+    rating = numpy.floor(rating)
+    ratingCat = numpy.full(len(rating), RATING_CATS.index('medium'),
+      dtype=numpy.int8)
+    ratingCat[rating <= 2] = RATING_CATS.index('low')
+    ratingCat[rating >= 4] = RATING_CATS.index('high')
+    return ratingCat
+
+
+def local_timestamp(year, month=1, day=1):
+    """Return the unix timestamp of the local midnight of a day"""
+    return int(time.mktime((year, month, day, 0, 0, 0, 0, 0, -1)))
+
+
+def timestamps_to_month(timestamp):
+    """Return the local year and month of an array of unix timestamps
+
+    Instead of calling datetime.fromtimestamp on every rating, the timestamps
+    are located between the local month boundaries.
+    """
+    if not len(timestamp):
+        return (numpy.zeros(0, dtype=numpy.int16),
+          numpy.zeros(0, dtype=numpy.int8))
+    first = datetime.datetime.fromtimestamp(int(timestamp.min())).year
+    last = datetime.datetime.fromtimestamp(int(timestamp.max())).year
+    months = numpy.arange(first * 12, (last + 1) * 12)
+    bounds = numpy.array([local_timestamp(month // 12, month % 12 + 1)
+      for month in months])
+    pos = numpy.searchsorted(bounds, timestamp, side='right') - 1
+    return ((months[pos] // 12).astype(numpy.int16),
+      (months[pos] % 12 + 1).astype(numpy.int8))
+
+
+def period_bounds(ratingYear=None, ratingMonth=None, ratingDates=None):
+    """Return the timestamp bounds of the periods of a dataset
+
+    Only one kind of period can be given:
+     * ratingYear: list of years
+     * ratingMonth: list of (year, month)
+     * ratingDates: list of (first, last) datetime.date, last excluded
+    The periods are merged and returned as a flat uint32 array of
+    [start, stop) timestamps, or None when there are no periods.
+    """
+    if len([periods for periods in (ratingYear, ratingMonth, ratingDates)
+      if periods != None]) > 1:
+        raise ValueError("Only one of ratingYear, ratingMonth and "
+          "ratingDates can be used")
+    if ratingYear != None:
+        periods = [(local_timestamp(year), local_timestamp(year + 1))
+          for year in ratingYear]
+    elif ratingMonth != None:
+        periods = [(local_timestamp(year, month),
+          local_timestamp(year + month // 12, month % 12 + 1))
+          for (year, month) in ratingMonth]
+    elif ratingDates != None:
+        periods = [(local_timestamp(first.year, first.month, first.day),
+          local_timestamp(last.year, last.month, last.day))
+          for (first, last) in ratingDates]
+    else:
+        return None
+
+    merged = []
+    for (start, stop) in sorted(periods):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        elif stop > start:
+            merged.append([start, stop])
+    bounds = numpy.array(merged, dtype=numpy.int64).ravel()
+    return numpy.clip(bounds, 0, 2 ** 32 - 1).astype(numpy.uint32)
+
+
 def parse_arguments():
     """ Function that parse main command line parameters
 
@@ -208,6 +739,21 @@ def parse_arguments():
         description='Proprocess tool for Movie Analysis')
     argParser.add_argument('config', help='Config file')
     argParser.add_argument('section',  help='Config file')
+    argParser.add_argument('--incremental', action='store_true',
+        help='Append only the transactions of the new ratings, when the '
+        'manifest of the last run allows it')
+    argParser.add_argument('--force', action='store_true',
+        help='Rebuild all the datasets, even the up to date ones')
+    argParser.add_argument('--profile', metavar='FILE',
+        help='Write the stage times and counters of the run as JSON')
+    argParser.add_argument('--trace-memory', action='store_true',
+        help='Add the tracemalloc peak of every stage to the metrics')
+    argParser.add_argument('--cprofile', metavar='FILE',
+        help='Dump the cProfile stats of the transaction writers, merged '
+        'with the ones of every process with --workers')
+    argParser.add_argument('--workers', type=int, default=1,
+        help='Processes writing the transactions, the output files are '
+        'the same as with a single one')
 
     args = argParser.parse_args()
 
@@ -240,11 +786,130 @@ def readYaml(filename):
 
 
 
+def compression_of(filename):
+    """Return the compression of a file, gzip, xz or None, by its magic"""
+    fh = open(filename, 'rb')
+    try:
+        magic = fh.read(len(XZ_MAGIC))
+    finally:
+        fh.close()
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(XZ_MAGIC):
+        return 'xz'
+    return None
+
+
+def open_input(filename):
+    """Open a file for reading, decompressing gzip and xz files on the fly"""
+    compression = compression_of(filename)
+    if compression == 'gzip':
+        return gzip.open(filename, 'rb')
+    if compression == 'xz':
+        if lzma is None:
+            raise IOError("%s is xz compressed and the lzma module is not "
+              "available" % filename)
+        return lzma.LZMAFile(filename, 'rb')
+    return open(filename, 'rb')
+
+
+class TransactionSink:
+    """Output file written by a background thread
+
+    Rows are gathered in buffers of SINK_BUFFER bytes, and every full
+    buffer is handed to a thread that writes it, compressed with gzip or xz
+    if requested, so the writes and the compression overlap with the
+    generation of the rows. zlib and lzma release the GIL while they
+    compress. Appending to a compressed file adds a new gzip member or xz
+    stream, which the readers decompress as one file.
+
+    rows and size count the lines and the uncompressed bytes written. The
+    file is opened by the constructor, which raises IOError if it can not
+    be opened. After a write error the rows are dropped, and the error is
+    raised by close.
+    """
+
+    def __init__(self, filename, mode='w', compression=None, header=None):
+        self.filename = filename
+        if compression == 'gzip':
+            self.fh = gzip.GzipFile(filename, mode + 'b', GZIP_LEVEL)
+        elif compression == 'xz':
+            if lzma is None:
+                raise IOError("xz compression needs the lzma module")
+            self.fh = lzma.LZMAFile(filename, mode + 'b')
+        elif compression is None:
+            self.fh = open(filename, mode + 'b')
+        else:
+            raise ValueError("Unknown compression %s" % compression)
+        self.queue = Queue.Queue(SINK_QUEUE)
+        self.buffer = []
+        self.buffered = 0
+        self.rows = 0
+        self.size = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+        if header:
+            self.write(header + '\n')
+
+    def _writer(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is None:
+                try:
+                    self.fh.write(data)
+                except Exception as e:
+                    self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise IOError("Error writing %s: %s" % (self.filename,
+              self.error))
+
+    def write(self, data, rows=1):
+        """Write the bytes of rows lines"""
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.rows += rows
+        if self.buffered >= SINK_BUFFER:
+            self.flush()
+
+    def flush(self):
+        """Hand the buffered rows to the writer thread"""
+        if self.buffer and self.error is None:
+            self.queue.put(b''.join(self.buffer))
+            self.size += self.buffered
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        """Write the pending rows and close the file"""
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.fh.close()
+        self._check()
+
+
+def open_sink(filename, mode='w', compression=None, header=None):
+    """Return a TransactionSink, or None if the file can not be opened"""
+    try:
+        return TransactionSink(filename, mode, compression, header)
+    except (IOError, OSError, ValueError) as e:
+        print("Error opening %s: %s" % (filename, e))
+        return None
+
+
 def read_csv_from_file(filename, sep=",", eol="\n"):
     """Return a generator with all the content of a column in a file"""
 
     try:
-        fh = open(filename, 'r')
+        fh = open_input(filename)
     except:
         yield None
 
@@ -260,47 +925,586 @@ def read_csv_from_file(filename, sep=",", eol="\n"):
         fh.close()
 
 
-def get_extra_info_from_movies(moviesDict, imdbFile):
-    """Get additional info from the input movies files.
+def read_blocks(filename, blockSize=BLOCK_SIZE, offset=0, end=None):
+    """Return a generator of large blocks of whole lines of a file
+
+    Only the bytes from offset to end (the end of the file if None) are
+    read.
+    """
+
+    fh = open_input(filename)
+    try:
+        if offset:
+            fh.seek(offset)
+        rest = b''
+        while True:
+            size = blockSize
+            if end is not None:
+                size = min(size, end - fh.tell())
+            block = fh.read(size) if size > 0 else b''
+            if not block:
+                break
+            block = rest + block
+            lastLine = block.rfind(b'\n') + 1
+            rest = block[lastLine:]
+            if lastLine:
+                yield block[:lastLine]
+        if rest:
+            yield rest + b'\n'
+    finally:
+        fh.close()
+
+
+def read_fields(filename, sep, nfields):
+    """Return the columns of a small separated file as lists of strings
+
+    The whole file is split at once instead of line by line.
+    """
+    fh = open_input(filename)
+    try:
+        data = fh.read()
+    finally:
+        fh.close()
+
+    data = data.replace(b'\r', b'').rstrip(b'\n')
+    if not data:
+        return [[] for i in range(nfields)]
+    fields = data.replace(b'\n', sep).split(sep)
+    if len(fields) % nfields:
+        raise ValueError("%s: every line must have %d fields" %
+          (filename, nfields))
+    return [fields[i::nfields] for i in range(nfields)]
+
+
+def _parse_numbers(block, table, dtype, nfields, filename):
+    """Parse a block of lines of numbers into a (lines, nfields) array
+
+    The separators listed in table are translated to blanks and the whole
+    block is converted by NumPy in a single call.
+    """
+    nlines = block.count(b'\n')
+    values = numpy.fromstring(block.translate(table), dtype=dtype, sep=' ')
+    if len(values) != nfields * nlines:
+        raise ValueError("%s: malformed rating line" % filename)
+    return values.reshape(nlines, nfields)
+
+
+def parse_ratings(filename, blockSize=BLOCK_SIZE, offset=0, end=None):
+    """Parse a ratings file in bulk
+
+    Both the ratings.txt layout (userid::movieid::rating::timestamp) and the
+    newer ratings.csv layout (header and float ratings) are supported. The
+    file is read in large blocks and every block is converted by NumPy.
+    Ratings with one decimal digit ("3.5") are parsed as two integers, which
+    is much faster than parsing floats.
+
+    Only the bytes from offset to end are parsed, see read_blocks.
+
+    Returns the userid, movieid, rating and timestamp columns.
+    """
+    header = True
+    columns = [[], [], [], []]
+    dtypes = [numpy.int32, numpy.int32, numpy.float32, numpy.uint32]
+    for block in read_blocks(filename, blockSize, offset, end):
+        if header:
+            header = False
+            # Skip the csv header
+            if not block[:1].isdigit():
+                block = block[block.index(b'\n') + 1:]
+
+        if b'.' not in block:
+            values = _parse_numbers(block, _SEPARATORS, numpy.int64, 4,
+              filename)
+            values = [values[:, i] for i in range(4)]
+        elif block.count(b'.') == block.count(b'\n') and \
+          not _LONG_DECIMAL.search(block):
+            values = _parse_numbers(block, _DECIMAL_SEPARATORS, numpy.int64,
+              5, filename)
+            rating = values[:, 2] + values[:, 3] / 10.0
+            values = [values[:, 0], values[:, 1], rating, values[:, 4]]
+        else:
+            values = _parse_numbers(block, _SEPARATORS, numpy.float64, 4,
+              filename)
+            values = [values[:, i] for i in range(4)]
+
+        for column, dtype, value in zip(columns, dtypes, values):
+            column.append(value.astype(dtype))
+
+    return [numpy.concatenate(column) if column else numpy.zeros(0, dtype)
+      for column, dtype in zip(columns, dtypes)]
+
+
+def parse_users(filename):
+    """Parse a users file in bulk
+
+    Returns the userid, sex, age, profession code and postcode columns.
+    userid and age are NumPy arrays.
+    """
+    (userids, sexes, ages, professionCodes, postcodes) = \
+      read_fields(filename, b'::', 5)
+    userids = numpy.array(userids).astype(numpy.int32)
+    ages = numpy.array(ages).astype(numpy.int16)
+    return userids, sexes, ages, professionCodes, postcodes
+
+
+def parse_movies(filename):
+    """Parse a movies file in bulk
+
+    Returns the movieid (NumPy array), title and genres columns.
+    """
+    (movieids, names, genres) = read_fields(filename, b'::', 3)
+    movieids = numpy.array(movieids).astype(numpy.int32)
+    return movieids, names, genres
+
+
+ImdbEntry = collections.namedtuple('ImdbEntry',
+  ['name', 'year', 'director', 'cast', 'imdbRating'])
+
 
-    The input is a dictionary of Movie object.
+class ImdbCache:
+    """Cache of the IMDB information of the movies
+
+    The cache file stores one JSON line per movie with only the enrichment
+    fields:
+        [id, name, year, director, cast, imdbRating]
+    The whole file is loaded at once when the cache is opened. New entries
+    are appended on sync(), so several runs can share the same file: the
+    file is read under a shared lock and appended under an exclusive one.
+    If a movie appears twice, the last line wins.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.pending = []
+        self.load()
+
+    def load(self):
+        """Read all the entries of the cache file"""
+        try:
+            fh = open(self.filename, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        try:
+            fcntl.flock(fh, fcntl.LOCK_SH)
+            data = fh.read()
+        finally:
+            fh.close()
+
+        # A line without EOL is still being written by another run
+        data = data[:data.rfind(b'\n') + 1]
+        lines = [line for line in data.split(b'\n') if line]
+        for row in json.loads(b'[' + b','.join(lines) + b']'):
+            self.entries[row[0]] = ImdbEntry(*row[1:])
+
+    def __contains__(self, movieid):
+        return movieid in self.entries
+
+    def __getitem__(self, movieid):
+        return self.entries[movieid]
+
+    def __setitem__(self, movieid, entry):
+        self.entries[movieid] = entry
+        self.pending.append(movieid)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _line(self, movieid):
+        row = [movieid]
+        row.extend(self.entries[movieid])
+        return json.dumps(row, separators=(',', ':')) + '\n'
+
+    def sync(self):
+        """Append the new entries to the cache file"""
+        if not self.pending:
+            return
+        data = ''.join(self._line(movieid) for movieid in self.pending)
+        fh = open(self.filename, 'ab')
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.write(data)
+            fh.flush()
+        finally:
+            fh.close()
+        self.pending = []
+
+    def compact(self):
+        """Rewrite the cache file with a single line per movie"""
+        self.pending = []
+        tmpFile = self.filename + '.tmp'
+        fh = open(tmpFile, 'wb')
+        try:
+            for movieid in sorted(self.entries):
+                fh.write(self._line(movieid))
+        finally:
+            fh.close()
+        os.rename(tmpFile, self.filename)
+
+    def close(self):
+        self.sync()
+
+
+class RateLimiter:
+    """Limit the requests per second of several threads
+
+    rate=None disables the limit.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next = time.time()
+
+    def wait(self):
+        """Block until the caller is allowed to send a request"""
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next)
+            self.next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class ImdbRequester:
+    """Perform IMDB requests with a rate limit and retries
+
+    A failed request is retried up to retries times, waiting backoff
+    seconds before the first retry and doubling the wait on each one.
+    """
+
+    def __init__(self, limiter=None, retries=0, backoff=1.0):
+        self.limiter = limiter if limiter else RateLimiter()
+        self.retries = retries
+        self.backoff = backoff
+
+    def __call__(self, function, *args):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            try:
+                return function(*args)
+            except imdb.IMDbError:
+                if attempt == self.retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+
+def get_imdb_movie(imdbObj, imdbID):
+    """Return the IMDB movie of an id
+
+    A client without reraiseExceptions returns an empty movie when the
+    request fails, so an answer without title is raised as an error too,
+    to be retried and never cached.
+    """
+    imdbMovieObj = imdbObj.get_movie(imdbID)
+    if 'title' not in imdbMovieObj.keys():
+        raise imdb.IMDbDataAccessError("empty answer for movie %s" % imdbID)
+    return imdbMovieObj
+
+
+def _imdb_worker(pending, results, clientArgs, request):
+    """Enrichment worker: query IMDB for the pending movies
+
+    Each worker reuses its own IMDb client for all its queries. If the
+    client can not be created, every movie the worker takes gets its error.
+    """
+    (imdbObj, clientError) = (None, None)
+    try:
+        imdbObj = imdb.IMDb(**clientArgs)
+    except Exception as e:
+        clientError = e
+    while True:
+        movieObj = pending.get()
+        if movieObj is None:
+            break
+        if clientError:
+            results.put((movieObj, clientError))
+            continue
+        try:
+            movieObj._queryImdb(imdbObj, request)
+            results.put((movieObj, None))
+        except Exception as e:
+            results.put((movieObj, e))
+
+
+def query_imdb_movies(movies, cache, workers=1, rate=None, retries=0,
+  backoff=1.0, url=None, clientArgs=None):
+    """Query IMDB for several movies with a pool of workers
+
+    The workers share the rate limit. Every answer is stored in the cache
+    by this thread, and the cache is synced every CHECKPOINT_SIZE movies, so
+    an interrupted run resumes from the last checkpoint. The clients raise
+    the failed requests, and the movies that still fail after the retries
+    are not cached, so the next run queries them again. clientArgs are
+    extra arguments of the IMDb clients.
+    """
+    pending = Queue.Queue()
+    results = Queue.Queue()
+    for movieObj in movies:
+        pending.put(movieObj)
+    for i in range(workers):
+        pending.put(None)
+
+    clientArgs = dict(clientArgs or {}, reraiseExceptions=True)
+    if url:
+        clientArgs['imdbURL_base'] = url
+    request = ImdbRequester(RateLimiter(rate), retries, backoff)
+    for i in range(workers):
+        worker = threading.Thread(target=_imdb_worker,
+          args=(pending, results, clientArgs, request))
+        worker.daemon = True
+        worker.start()
+
+    for done in range(1, len(movies) + 1):
+        # Wait with a timeout, so the main thread can be interrupted
+        while True:
+            try:
+                (movieObj, error) = results.get(timeout=1)
+                break
+            except Queue.Empty:
+                pass
+
+        if error:
+            print("Warning: movie %s could not be queried on IMDB: %s" %
+              (movieObj.imdbName, error))
+            metrics.count('imdb.queryErrors')
+            continue
+        cache[movieObj.id] = movieObj.cacheEntry()
+        movieObj.categorize()
+        if done % CHECKPOINT_SIZE == 0:
+            cache.sync()
+
+
+def normalize_title(title):
+    """Return a title lowercased, without accents and with single spaces
+    instead of the punctuation"""
+    title = unicodedata.normalize('NFKD', title)
+    title = u''.join(c for c in title if not unicodedata.combining(c))
+    return _TITLE_SYMBOLS.sub(u' ', title.lower()).strip()
+
+
+def movielens_titles(name):
+    """Return the normalized titles and the year of a MovieLens movie name
+
+    "Title, The (Alternate title) (1995)" gives "the title" and "alternate
+    title". The year is None if the name has none.
+    """
+    match = _TITLE_YEAR.match(name)
+    if not match:
+        return [], None
+    (name, year) = match.groups()
+    titles = [name]
+    match = _TITLE_ALTERNATE.match(name)
+    if match:
+        titles = list(match.groups())
+    normalized = []
+    for title in titles:
+        match = _TITLE_ARTICLE.match(title)
+        if match:
+            (title, article) = match.groups()
+            title = article + u' ' + title
+        normalized.append(normalize_title(title))
+    return normalized, int(year)
+
+
+def read_imdb_dump(directory, name, fields, keys=None):
+    """Yield the fields of the rows of an IMDB dataset dump
+
+    The dump is <directory>/<name>.tsv.gz or <name>.tsv. The \\N nulls are
+    returned as None. With keys, only the rows whose first column (tconst or
+    nconst) is in keys are split.
+    """
+    filename = os.path.join(directory, name + '.tsv.gz')
+    if not os.path.isfile(filename):
+        filename = os.path.join(directory, name + '.tsv')
+    fh = open_input(filename)
+    try:
+        header = fh.readline().rstrip('\n').split('\t')
+        positions = [header.index(field) for field in fields]
+        for line in fh:
+            if keys is not None and line[:line.find('\t')] not in keys:
+                continue
+            row = line.rstrip('\n').split('\t')
+            yield [None if row[i] == '\\N' else row[i] for i in positions]
+    finally:
+        fh.close()
+
+
+def query_imdb_dumps(movies, cache, directory):
+    """Get the IMDB information of the movies from the IMDB dataset dumps
+
+    The dumps are joined with the movies in a single pass over each one:
+    title.basics is probed with the normalized (title, year) of the movies,
+    and the other dumps are only split for the matched titles and their
+    people. A movie matches the titles of its year, or of the year before or
+    after when there is none, preferring movies to other kinds of titles
+    and then the titles with more votes. Every movie is stored in the cache,
+    as the IMDB queries do.
     """
-    #fhWrite = open(imdbFile, "a")
-    #fhRead = open(imdbFile, "r")
-    cache = shelve.open(imdbFile)
-    # XXX: limited to 10 rows just for testing
-    #for movieObj in list(moviesDict.values())[:5]:
-    for movieObj in list(moviesDict.values()):
-        movieObj.getExtraInfo(cache)
+    # Build side of the join: the movies by normalized title and year
+    index = {}
+    for movieObj in movies:
+        (titles, year) = movielens_titles(movieObj.imdbName.decode('latin-1'))
+        for title in titles:
+            index.setdefault((title, year), []).append(movieObj)
+    years = set(year + delta for (title, year) in index for delta in (-1, 0, 1))
+
+    candidates = {}
+    basics = {}
+    for (tconst, titleType, primaryTitle, originalTitle,
+      startYear) in read_imdb_dump(directory, 'title.basics', ('tconst',
+      'titleType', 'primaryTitle', 'originalTitle', 'startYear')):
+        typeRank = IMDB_TITLE_TYPES.get(titleType)
+        if typeRank is None or startYear is None:
+            continue
+        startYear = int(startYear)
+        if startYear not in years:
+            continue
+        titles = set([normalize_title(primaryTitle.decode('utf-8'))])
+        if originalTitle and originalTitle != primaryTitle:
+            titles.add(normalize_title(originalTitle.decode('utf-8')))
+        for delta in (0, -1, 1):
+            for title in titles:
+                for movieObj in index.get((title, startYear + delta), ()):
+                    candidates.setdefault(movieObj.id, []).append(
+                      (abs(delta), typeRank, tconst))
+                    basics[tconst] = (primaryTitle.decode('utf-8'),
+                      startYear)
+
+    ratings = {}
+    for (tconst, averageRating, numVotes) in read_imdb_dump(directory,
+      'title.ratings', ('tconst', 'averageRating', 'numVotes'), basics):
+        ratings[tconst] = (float(averageRating), int(numVotes))
+    matches = {}
+    for movieid, titles in candidates.items():
+        matches[movieid] = min(titles, key=lambda title: (title[0], title[1],
+          -ratings.get(title[2], (0, 0))[1], title[2]))[2]
+    matched = set(matches.values())
+
+    directors = {}
+    for (tconst, nconsts) in read_imdb_dump(directory, 'title.crew',
+      ('tconst', 'directors'), matched):
+        if nconsts:
+            directors[tconst] = nconsts.split(',')[0]
+    principals = {}
+    for (tconst, ordering, nconst, category) in read_imdb_dump(directory,
+      'title.principals', ('tconst', 'ordering', 'nconst', 'category'),
+      matched):
+        if category in IMDB_CAST_CATEGORIES:
+            principals.setdefault(tconst, []).append((int(ordering), nconst))
+    casts = dict((tconst, [nconst for (ordering, nconst) in
+      sorted(principals[tconst])[:CAST_SIZE]]) for tconst in principals)
+    people = set(directors.values())
+    for nconsts in casts.values():
+        people.update(nconsts)
+    names = {}
+    for (nconst, primaryName) in read_imdb_dump(directory, 'name.basics',
+      ('nconst', 'primaryName'), people):
+        names[nconst] = primaryName.decode('utf-8') if primaryName else None
+
+    for movieObj in movies:
+        tconst = matches.get(movieObj.id)
+        if tconst is None:
+            print("Warning: movie %s was not found on the IMDB dumps." %
+              movieObj.imdbName)
+            metrics.count('imdb.notFound')
+        else:
+            (movieObj.name, movieObj.year) = basics[tconst]
+            if tconst in directors:
+                movieObj.director = names.get(directors[tconst])
+            cast = [names[nconst] for nconst in casts.get(tconst, ())
+              if names.get(nconst)]
+            movieObj.cast = cast or None
+            if tconst in ratings:
+                movieObj.imdbRating = ratings[tconst][0]
+        cache[movieObj.id] = movieObj.cacheEntry()
         movieObj.categorize()
 
-    cache.close()
-    #fhWrite.close()
-    #fhRead.close()
+
+def migrate_imdb_cache(imdbFile):
+    """Convert the shelve IMDB cache of older versions next to imdbFile
+
+    When imdbFile does not exist but <name>.dat does, the shelve is
+    converted by bin/migrate_imdb_cache.py. Returns False if the conversion
+    failed.
+    """
+    shelveFile = os.path.splitext(imdbFile)[0] + '.dat'
+    if os.path.exists(imdbFile) or not os.path.isfile(shelveFile):
+        return True
+    print("Migrating the shelve IMDB cache %s to %s" % (shelveFile, imdbFile))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+      'migrate_imdb_cache.py')
+    if subprocess.call([sys.executable, script, shelveFile, imdbFile]):
+        print("Error migrating the IMDB cache, convert it with "
+          "bin/migrate_imdb_cache.py or copy config/imdb_cache.jsonl")
+        return False
+    return True
+
+
+def get_extra_info_from_movies(moviesDict, imdbFile, workers=1, rate=None,
+  retries=0, backoff=1.0, url=None, dumps=None):
+    """Get additional info from the input movies files.
+
+    The input is a dictionary of Movie object. The movies found in the cache
+    are loaded from it, the rest are queried by query_imdb_movies, or read
+    from the IMDB dataset dumps of the dumps directory by query_imdb_dumps.
+    Returns the number of movies queried.
+    """
+    cache = ImdbCache(imdbFile)
+    try:
+        missing = []
+        for movieObj in list(moviesDict.values()):
+            if movieObj.id in cache:
+                movieObj.getExtraInfo(cache)
+                movieObj.categorize()
+            else:
+                missing.append(movieObj)
+
+        if missing and dumps:
+            metrics.count('imdb.cacheMisses', len(missing))
+            query_imdb_dumps(missing, cache, dumps)
+        elif missing:
+            metrics.count('imdb.cacheMisses', len(missing))
+            query_imdb_movies(missing, cache, workers, rate, retries, backoff,
+              url)
+    finally:
+        cache.close()
+    return len(missing)
 
 def load_movies(filename):
     """Return a dictionary of movies objects given a movies input file"""
 
-    moviesGen = read_csv_from_file(filename,  sep='::')
-    if not moviesGen:
+    try:
+        (movieids, names, genres) = parse_movies(filename)
+    except IOError:
         print("Error reading movies file")
         return None
+    except ValueError as e:
+        print("Error reading movies file: %s" % e)
+        return None
     
     ret = {}
     # Iterate over all the file
-    for line in moviesGen:
-        (movieID, name, genres) = line
+    for (movieID, name, movieGenres) in zip(movieids.tolist(), names, genres):
+        movieID = str(movieID)
         if movieID not in ret:
             # The movie is not in the dictionary. Lets add it
             # 1st Construct the Movie Obj
             movie = Movie()
             movie.id = movieID
             movie.imdbName = name
-            movie.genre = genres.split('|')
+            movie.genre = movieGenres.split('|')
             
             # 2nd Add it to the return dict
             ret[movie.id] = movie
 
+    metrics.count('rows.movies', len(movieids))
     return ret
     
 
@@ -318,62 +1522,185 @@ def getGenreList(moviesDict):
 def load_users(filename):
     """Return a dictionary of User objects given a movies input file"""
 
-    usersGen = read_csv_from_file(filename,  sep='::')
-    if not usersGen:
+    try:
+        (userids, sexes, ages, professionCodes, postcodes) = \
+          parse_users(filename)
+    except IOError:
         print("Error reading users file")
         return None
+    except ValueError as e:
+        print("Error reading users file: %s" % e)
+        return None
     
     ret = {}
     # Iterate over all the file
-    for line in usersGen:
+    for line in zip(map(str, userids.tolist()), sexes, ages.tolist(),
+      professionCodes, postcodes):
         userID = line[0]
         if userID not in ret:
             user = User()
             user.fromFile(line)
             ret[userID] = user
 
+    metrics.count('rows.users', len(userids))
     return ret
  
 
 
-def load_rating(filename):
-    """Return a dictionary of movies objects given a movies input file"""
+def load_rating(filename, offset=0, end=None):
+    """Return a RatingStore given a rating input file
 
-    ratingGen = read_csv_from_file(filename,  sep='::')
-    if not ratingGen:
+    offset and end limit the ratings to a part of the file, see read_blocks.
+    """
+
+    try:
+        (userids, movieids, ratings, timestamps) = parse_ratings(filename,
+          offset=offset, end=end)
+    except IOError:
         print("Error reading rating file")
         return None
-    
-    ret = set()
-    # Iterate over all the file
-    for line in ratingGen:
-        (userid, movieid, rating, timestamp) = line
-        ratingObj = Rating()
-        ratingObj.userid = userid
-        ratingObj.movieid = movieid
-        ratingObj.rating = rating
-        ratingObj.timestamp = timestamp
-        ratingObj.categorize()
-        
-        ret.add(ratingObj)
+    except ValueError as e:
+        print("Error reading rating file: %s" % e)
+        return None
 
-    return ret
+    metrics.count('rows.ratings', len(userids))
+    return RatingStore(userids, movieids, ratings, timestamps)
+
+
+
+def normalize_tag(tag):
+    """Return a tag lowercased, with single spaces and without quotes or
+    surrounding punctuation, None if nothing is left"""
+    try:
+        tag = tag.decode('utf-8')
+    except UnicodeDecodeError:
+        tag = tag.decode('latin-1')
+    tag = _TAG_SPACES.sub(u' ', tag.replace(u'"', u' ').lower())
+    return tag.strip(_TAG_STRIP) or None
+
+
+class TagCounter:
+    """Approximate tag counts of a movie, by the Space-Saving algorithm
+
+    At most capacity tags are tracked: a new tag replaces the least counted
+    one and takes its count plus one, and the count of the replaced tag is
+    kept as the error of the new one. The counts are exact while there are
+    fewer distinct tags than capacity, and upper bounds afterwards: a tag
+    was used at least count - error times, and every tag used more than
+    n / capacity times of n is tracked.
+    """
+
+    __slots__ = ('counts', 'errors', 'capacity')
+
+    def __init__(self, capacity=TAG_CAPACITY):
+        self.counts = {}
+        self.errors = {}
+        self.capacity = capacity
 
+    def add(self, tag):
+        """Count a tag"""
+        counts = self.counts
+        if tag in counts:
+            counts[tag] += 1
+        elif len(counts) < self.capacity:
+            counts[tag] = 1
+        else:
+            victim = min(counts, key=counts.get)
+            self.errors.pop(victim, None)
+            error = self.errors[tag] = counts.pop(victim)
+            counts[tag] = error + 1
+
+    def top(self, minFreq=1, top=None):
+        """Return the tags surely used at least minFreq times, the top ones
+        if top is given, most used first
+
+        Tags are filtered and ranked by their guaranteed count, count -
+        error, so no tag used fewer than minFreq times is returned.
+        """
+        guaranteed = dict((tag, count - self.errors.get(tag, 0))
+          for tag, count in self.counts.items())
+        tags = sorted((tag for tag, count in guaranteed.items()
+          if count >= minFreq), key=lambda tag: (-guaranteed[tag],
+          -self.counts[tag], tag))
+        return tags[:top] if top else tags
+
+
+def load_tags(filename, moviesDict, minFreq=1, top=None,
+  capacity=TAG_CAPACITY):
+    """Set the tags of the movies from a tags file
+
+    The file has userid, movieid, tag and timestamp tab separated lines.
+    Tags are normalized and counted per movie as the file is read, keeping
+    only capacity tags per movie (see TagCounter). Every movie gets the tags
+    used at least minFreq times on it, at most top of them. Returns the
+    number of tags set, None if the file can not be read.
+    """
+    counters = {}
+    rows = 0
+    try:
+        for block in read_blocks(filename):
+            for line in block.splitlines():
+                fields = line.split(b'\t')
+                if len(fields) < 3 or fields[1] not in moviesDict:
+                    continue
+                tag = normalize_tag(fields[2])
+                if tag is None:
+                    continue
+                counter = counters.get(fields[1])
+                if counter is None:
+                    counter = counters[fields[1]] = TagCounter(capacity)
+                counter.add(tag)
+                rows += 1
+    except IOError:
+        print("Error reading tags file")
+        return None
+
+    metrics.count('rows.tags', rows)
+    ntags = 0
+    for movieid, counter in counters.items():
+        tags = counter.top(minFreq, top)
+        moviesDict[movieid].tags = tags or None
+        ntags += len(tags)
+    return ntags
 
 
-def assign_rating(ratingSet, moviesDict=None, usersDict=None):
+
+def _groups(values):
+    """Return the distinct values of a sorted array with their [start, stop)"""
+    if not len(values):
+        return [], [], []
+    starts = numpy.flatnonzero(numpy.diff(values)) + 1
+    starts = numpy.concatenate(([0], starts))
+    stops = numpy.concatenate((starts[1:], [len(values)]))
+    return values[starts].tolist(), starts.tolist(), stops.tolist()
+
+
+
+def assign_rating(ratingStore, moviesDict=None, usersDict=None):
     """Assign rating to users or movies
 
-    Given a set of Rating object, it is assigned to a movie or user
-    dictionary
+    Given a RatingStore, the store is sorted by movie and timestamp and every
+    movie gets a RatingList with its slice of the store. Every user gets a
+    RatingList with the positions of its ratings.
     """
-    for ratingObj in ratingSet:
-        # Add the rating into the movies dict
-        if moviesDict and ratingObj.movieid in moviesDict:
-            moviesDict[ratingObj.movieid].rating.append(ratingObj)
-        # Add the rating into the users dict
-        if usersDict and ratingObj.userid in usersDict:
-            usersDict[ratingObj.userid].rating.append(ratingObj)
+    ratingStore.take(numpy.lexsort((ratingStore.timestamp,
+      ratingStore.movieid)))
+
+    if moviesDict:
+        movieids, starts, stops = _groups(ratingStore.movieid)
+        for movieid, start, stop in zip(movieids, starts, stops):
+            movie = moviesDict.get(str(movieid))
+            if movie:
+                movie.rating = RatingList(ratingStore, slice(start, stop))
+
+    if usersDict:
+        order = numpy.argsort(ratingStore.userid, kind='mergesort')
+        order = order.astype(numpy.int32)
+        userids, starts, stops = _groups(ratingStore.userid[order])
+        for userid, start, stop in zip(userids, starts, stops):
+            user = usersDict.get(str(userid))
+            if user:
+                user.rating = RatingList(ratingStore, order[start:stop])
 
     return
 
@@ -383,9 +1710,8 @@ def assign_rating(ratingSet, moviesDict=None, usersDict=None):
 def writeOutput1(filename, moviesDict, usersDict):
 
     # Open the File
-    try:
-        fh = open(filename, 'w')
-    except:
+    fh = open_sink(filename)
+    if fh is None:
         return None
 
     for movie in moviesDict.values():
@@ -414,8 +1740,7 @@ def writeOutput1(filename, moviesDict, usersDict):
                         lst.extend(fixedRating)
                         lst = map(unicode, lst)
                         line = '|'.join(lst)
-                        fh.write(line.encode('utf-8'))
-                        fh.write('\n')
+                        fh.write(line.encode('utf-8') + '\n')
     fh.close()
 
 
@@ -424,16 +1749,14 @@ def writeOutputLikes1(filename, moviesDict, usersDict):
 
     CSV_CHAR = ','
     # Open the File
-    try:
-        fh = open(filename, 'w')
-    except:
+    fh = open_sink(filename)
+    if fh is None:
         return None
 
     # Write the header
     header = ['tid', 'name', 'year', 'director', 'actor', 'genre', 'uid', 'sex', 'ageCat', 'prefession', 'citi', 'state', 'rating']
     line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
+    fh.write(line.encode('utf-8') + '\n')
     
 
     transid = 0
@@ -461,8 +1784,7 @@ def writeOutputLikes1(filename, moviesDict, usersDict):
                 lst.extend(fixedRating)
                 lst = map(unicode, lst)
                 line = CSV_CHAR.join(lst)
-                fh.write(line.encode('utf-8'))
-                fh.write('\n')
+                fh.write(line.encode('utf-8') + '\n')
                
                 lstAct = ['?'] * len(lst)
                 lstAct[0] = transid
@@ -471,8 +1793,7 @@ def writeOutputLikes1(filename, moviesDict, usersDict):
 
                     lstAct = map(unicode, lstAct)
                     line = CSV_CHAR.join(lstAct)
-                    fh.write(line.encode('utf-8'))
-                    fh.write('\n')
+                    fh.write(line.encode('utf-8') + '\n')
                     
                 lstGen = ['?'] * len(lst)
                 lstGen[0] = transid
@@ -481,8 +1802,7 @@ def writeOutputLikes1(filename, moviesDict, usersDict):
 
                     lstGen = map(unicode, lstGen)
                     line = CSV_CHAR.join(lstGen)
-                    fh.write(line.encode('utf-8'))
-                    fh.write('\n')
+                    fh.write(line.encode('utf-8') + '\n')
    
     fh.close()
     
@@ -492,16 +1812,14 @@ def writeOutputLikes2(filename, moviesDict, usersDict):
 
     CSV_CHAR = ','
     # Open the File
-    try:
-        fh = open(filename, 'w')
-    except:
+    fh = open_sink(filename)
+    if fh is None:
         return None
 
     # Write the header
     header = ['tid', 'name', 'year', 'director', 'actor', 'genre', 'uid', 'sex', 'ageCat', 'prefession', 'citi', 'state', 'rating']
     line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
+    fh.write(line.encode('utf-8') + '\n')
     
 
     transid = 0
@@ -529,8 +1847,7 @@ def writeOutputLikes2(filename, moviesDict, usersDict):
                 lst.extend(fixedRating)
                 lst = map(unicode, lst)
                 line = CSV_CHAR.join(lst)
-                fh.write(line.encode('utf-8'))
-                fh.write('\n')
+                fh.write(line.encode('utf-8') + '\n')
                
                 lstAct = lst[:]
                 for actor in cast:
@@ -538,8 +1855,7 @@ def writeOutputLikes2(filename, moviesDict, usersDict):
 
                     lstAct = map(unicode, lstAct)
                     line = CSV_CHAR.join(lstAct)
-                    fh.write(line.encode('utf-8'))
-                    fh.write('\n')
+                    fh.write(line.encode('utf-8') + '\n')
                     
                 lstGen = lst[:]
                 for genre in genres:
@@ -547,8 +1863,7 @@ def writeOutputLikes2(filename, moviesDict, usersDict):
 
                     lstGen = map(unicode, lstGen)
                     line = CSV_CHAR.join(lstGen)
-                    fh.write(line.encode('utf-8'))
-                    fh.write('\n')
+                    fh.write(line.encode('utf-8') + '\n')
    
     fh.close()
  
@@ -558,16 +1873,14 @@ def writeOutputLikes3(filename, moviesDict, usersDict):
 
     CSV_CHAR = ','
     # Open the File
-    try:
-        fh = open(filename, 'w')
-    except:
+    fh = open_sink(filename)
+    if fh is None:
         return None
 
     # Write the header
     header = ['tid', 'name', 'year', 'director', 'actor', 'genre', 'uid', 'sex', 'ageCat', 'prefession', 'citi', 'state', 'rating']
     line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
+    fh.write(line.encode('utf-8') + '\n')
     
 
     transid = 0
@@ -595,8 +1908,7 @@ def writeOutputLikes3(filename, moviesDict, usersDict):
                     lst.extend(fixedRating)
                     lst = map(unicode, lst)
                     line = CSV_CHAR.join(lst)
-                    fh.write(line.encode('utf-8'))
-                    fh.write('\n')
+                    fh.write(line.encode('utf-8') + '\n')
                
     fh.close()
 
@@ -606,9 +1918,8 @@ def writeOutputLikes4(filename, moviesDict, usersDict, genreList):
 
     CSV_CHAR = ','
     # Open the File
-    try:
-        fh = open(filename, 'w')
-    except:
+    fh = open_sink(filename)
+    if fh is None:
         return None
 
     # Write the header
@@ -616,8 +1927,7 @@ def writeOutputLikes4(filename, moviesDict, usersDict, genreList):
     genreHeader = list(map((lambda x: "genre_" + re.sub("'",'',x)), genreList[:]))
     header.extend(genreHeader)
     line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
+    fh.write(line.encode('utf-8') + '\n')
     
 
     for movie in moviesDict.values():
@@ -643,289 +1953,1186 @@ def writeOutputLikes4(filename, moviesDict, usersDict, genreList):
                 lst.extend(genreDummy)
                 lst = map(unicode, lst)
                 line = CSV_CHAR.join(lst)
-                fh.write(line.encode('utf-8'))
-                fh.write('\n')
+                fh.write(line.encode('utf-8') + '\n')
                
     fh.close()
 
 
 
-def writeTransActorDirectors(filename, moviesDict, usersDict):
-    """Write a transaction file ready to be process by R.
+class ItemDictionary:
+    """Integer ids of the transaction items
 
-    It will write all the processed items on the target"""
-    CSV_CHAR = ','
-    # Open the File
-    try:
+    A single dictionary is shared by all the outputs of a run, so an item has
+    the same id in every output. The dictionary file maps the ids to the
+    labels:
+        itemid,label
+        1,"Toy Story"
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.labels = []
+
+    def id(self, label):
+        """Return the id of a label, adding it if it is new"""
+        itemid = self.ids.get(label)
+        if itemid is None:
+            self.labels.append(label)
+            itemid = self.ids[label] = len(self.labels)
+        return itemid
+
+    def __getitem__(self, itemid):
+        """Return the label of an id"""
+        return self.labels[itemid - 1]
+
+    def read(self, filename):
+        """Load the ids of a dictionary file written by a previous run"""
+        fh = open_input(filename)
+        try:
+            fh.readline()
+            for line in fh:
+                (itemid, label) = line.rstrip('\n').split(',', 1)
+                label = label[1:-1].decode('utf-8')
+                self.labels.append(label)
+                self.ids[label] = int(itemid)
+        finally:
+            fh.close()
+
+    def write(self, filename):
+        """Write the dictionary file"""
         fh = open(filename, 'w')
-    except:
-        return None
+        try:
+            fh.write('itemid,label\n')
+            for itemid, label in enumerate(self.labels, 1):
+                fh.write(('%d,"%s"\n' % (itemid, label)).encode('utf-8'))
+        finally:
+            fh.close()
 
-    # Write the header
-    header = ['tid', 'pid']
-    line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
-    
 
-    transid = 0
-    for movie in moviesDict.values():
-        if movie.rating and movie.imdbRating:
-            
-            cast = movie.cast if movie.cast else ['?']
-            genres = movie.genre if movie.genre else ['?']
-            fixedMovie = [movie.name, movie.yearCat, movie.director ]
-            for rating in movie.rating:
-                transid += 1
-                user = usersDict[rating.userid]
-                fixedUser = [user.id, user.sex, user.ageCat, user.profession, 
-                  user.citi, user.state]
-                fixedRating = [ rating.ratingCat]
- 
-                lst = fixedMovie[:]
-                lst.extend(fixedUser)
-                lst.extend(fixedRating)
-                lst.extend(cast)
-                lst.extend(genres)
-                lst = map(unicode, lst)
-                for item in lst:
-                    fh.write(('%d,"%s"\n' %(transid, item)).encode('utf-8'))
+# Entries of the Matrix Market file formatted at once
+MATRIX_CHUNK = 100000
 
-    fh.close()
 
+def write_matrix(filename, transactions, labels, formats):
+    """Write the incidence matrix of a TransactionSet
 
+    formats lists the files to write:
+     * npz: CSR matrix with the keys of scipy.sparse.save_npz, so
+        scipy.sparse.load_npz reads it
+     * mtx: Matrix Market coordinate file, one based
+    The labels of the columns are written one per line to filename.labels.
+    """
+    (indptr, indices, columns) = transactions.matrix()
+    shape = (len(transactions), len(columns))
+    if 'npz' in formats:
+        numpy.savez_compressed(filename + '.npz', format=b'csr',
+          shape=numpy.array(shape), data=numpy.ones(len(indices),
+          dtype=numpy.int8), indices=indices, indptr=indptr)
+    if 'mtx' in formats:
+        rows = numpy.repeat(numpy.arange(1, shape[0] + 1), numpy.diff(indptr))
+        entries = numpy.column_stack((rows, indices + 1))
+        fh = open(filename + '.mtx', 'w')
+        try:
+            fh.write('%%MatrixMarket matrix coordinate integer general\n')
+            fh.write('%% rows: transactions, columns: %s\n' %
+              os.path.basename(filename + '.labels'))
+            fh.write('%d %d %d\n' % (shape[0], shape[1], len(indices)))
+            for start in range(0, len(entries), MATRIX_CHUNK):
+                chunk = entries[start:start + MATRIX_CHUNK]
+                fh.write('%d %d 1\n' * len(chunk) % tuple(chunk.ravel().tolist()))
+        finally:
+            fh.close()
+
+    fh = open(filename + '.labels', 'w')
+    try:
+        for itemid in columns.tolist():
+            fh.write((u'%s\n' % labels[itemid]).encode('utf-8'))
+    finally:
+        fh.close()
 
-def writeOutputLikes5(filename, moviesDict, usersDict):
-    """Write a transaction file ready to be process by R.
 
-    It will write all the processed items on the target"""
-    CSV_CHAR = ','
-    # Open the File
-    try:
-        fh = open(filename, 'w')
-    except:
-        return None
+class Sampler:
+    """Sample of the transactions of an output, drawn during the scan
+
+    The parameters are:
+     * size: reservoir sample of size transactions
+     * fraction: sample of that fraction of the transactions
+     * by: stratify by ratingCat, year (of the rating) or ageCat
+     * seed: seed of the random numbers, the same seed gives the same sample
+    A fraction without by keeps every transaction with that probability
+    (Bernoulli). With by, every stratum keeps exactly its fraction of the
+    transactions, a systematic sample with a random start. A size without
+    by is a single reservoir; with by, every stratum keeps a reservoir of
+    size transactions, and the sample takes from each one its share of
+    size, proportional to the size of the stratum.
+    The reservoirs keep (movie, userid, ratingCat code) references, and
+    their transactions are built at the end of the scan, in scan order.
+    """
 
-    # Write the header
-    header = ['tid', 'pid']
-    line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
-    
+    def __init__(self, size=None, fraction=None, by=None, seed=0):
+        if (size is None) == (fraction is None):
+            raise ValueError("A sample needs either a size or a fraction")
+        if size is not None and size < 1 or \
+          fraction is not None and not 0 < fraction <= 1:
+            raise ValueError("Wrong sample size or fraction")
+        if by not in (None, 'ratingCat', 'year', 'ageCat'):
+            raise ValueError("Unknown sample stratum %s" % by)
+        self.size = size
+        self.fraction = fraction
+        self.by = by
+        self.random = numpy.random.RandomState(seed)
+        self.seen = collections.defaultdict(int)
+        self.starts = {}
+        self.reservoirs = collections.defaultdict(list)
+        self.count = 0
+        self.ageCats = None
+
+    def start(self, usersById):
+        """Prepare the strata of a scan over the users of usersById"""
+        if self.by == 'ageCat':
+            self.ageCats = numpy.zeros(max(usersById) + 1, dtype=numpy.int8)
+            for userid, user in usersById.items():
+                self.ageCats[userid] = user._ageCat
+
+    def strata(self, store, index, keep, userids, ratingCats):
+        """Return the strata of the kept ratings of a slice of the store"""
+        if self.by == 'ratingCat':
+            return ratingCats
+        if self.by == 'year':
+            return store.year[index][keep]
+        if self.by == 'ageCat':
+            return self.ageCats[userids]
+        return numpy.zeros(len(userids), dtype=numpy.int8)
+
+    def select(self, strata, movie, userids, ratingCats):
+        """Return the mask of the transactions to write now
+
+        The transactions that go to a reservoir are kept instead, and the
+        mask is all False.
+        """
+        selected = numpy.zeros(len(strata), dtype=bool)
+        for stratum in numpy.unique(strata).tolist():
+            positions = numpy.flatnonzero(strata == stratum)
+            seen = self.seen[stratum]
+            self.seen[stratum] += len(positions)
+            # Index of every transaction inside its stratum
+            k = numpy.arange(seen, seen + len(positions), dtype=numpy.float64)
+            if self.size is not None:
+                self._fill(self.reservoirs[stratum], k, positions, movie,
+                  userids, ratingCats)
+            elif self.by is None:
+                selected[positions] = \
+                  self.random.random_sample(len(positions)) < self.fraction
+            else:
+                start = self.starts.get(stratum)
+                if start is None:
+                    start = self.starts[stratum] = self.random.random_sample()
+                selected[positions] = \
+                  numpy.floor((k + 1) * self.fraction + start) > \
+                  numpy.floor(k * self.fraction + start)
+        self.count += len(strata)
+        return selected
+
+    def _fill(self, reservoir, k, positions, movie, userids, ratingCats):
+        """Offer transactions to a reservoir (algorithm R)"""
+        # The k-th transaction takes a random slot of k + 1, kept if it is
+        # one of the size slots of the reservoir
+        slots = numpy.floor(self.random.random_sample(len(k)) * (k + 1))
+        slots = numpy.where(k < self.size, k, slots).astype(numpy.int64)
+        for slot, position in zip(slots.tolist(), positions.tolist()):
+            if slot < self.size:
+                entry = (self.count + position, movie, int(userids[position]),
+                  int(ratingCats[position]))
+                if slot < len(reservoir):
+                    reservoir[slot] = entry
+                else:
+                    reservoir.append(entry)
+
+    def reservoir(self):
+        """Return the (movie, userid, ratingCat code) of the transactions of
+        the reservoirs, in scan order"""
+        entries = []
+        total = sum(self.seen.values())
+        if self.by is None or total <= self.size:
+            for reservoir in self.reservoirs.values():
+                entries.extend(reservoir)
+        else:
+            # Largest remainder allocation of size among the strata
+            strata = sorted(self.reservoirs)
+            shares = [float(self.size) * self.seen[stratum] / total
+              for stratum in strata]
+            counts = [int(share) for share in shares]
+            order = sorted(range(len(strata)),
+              key=lambda i: counts[i] - shares[i])
+            for i in order[:self.size - sum(counts)]:
+                counts[i] += 1
+            for stratum, count in zip(strata, counts):
+                reservoir = self.reservoirs[stratum]
+                chosen = self.random.choice(len(reservoir), count,
+                  replace=False)
+                entries.extend(reservoir[i] for i in chosen.tolist())
+        entries.sort(key=lambda entry: entry[0])
+        self.reservoirs = collections.defaultdict(list)
+        return [entry[1:] for entry in entries]
+
+
+class TransactionOutput:
+    """Definition of one transaction file written by write_transactions
+
+    Every transaction is built as:
+        head items + user items + [ratingCat] + tail items
+    The parameters are:
+     * filename: output filename
+     * movieItems: function that given a movie returns the (head, tail) items
+     * userItems: function that given an user returns its items
+     * ranking: rating category (or list of categories) to keep. If
+        ranking=None, all the transactions are written
+     * ratingItem: write the rating category as an item
+     * ratingYear: list that filter only the years that the rating were performed
+     * ratingMonth: list of (year, month) that filter the ratings by month
+     * ratingDates: list of (first, last) datetime.date that filter the
+        ratings by date, last excluded
+     * format: "labels" writes tid,"item" lines. "ids" writes tid,itemid
+        lines, and the labels go to the ItemDictionary of the run
+     * mining: dictionary with the minsup, minconf, minlift and maxlen of
+        the rules to mine from the transactions, and the rules file to
+        write. filename can be None to mine without writing the
+        transactions
+     * matrix: list of incidence matrix files to write next to the
+        output, npz and/or mtx, see write_matrix
+     * compression: gzip or xz to compress the output while it is written,
+        see TransactionSink
+     * prune: relative minimum support of the written items. The supports
+        are counted by a first pass, see count_supports, and the pruning
+        statistics go to <filename>.prune.json
+     * sampler: Sampler of the written transactions
+    """
 
-    transid = 0
-    for movie in moviesDict.values():
-        if movie.rating and movie.imdbRating:
-            
-            cast = movie.cast if movie.cast else ['?']
-            genres = movie.genre if movie.genre else ['?']
-            fixedMovie = [movie.name, movie.yearCat, movie.director ]
-            for rating in movie.rating:
-                transid += 1
-                user = usersDict[rating.userid]
-                fixedUser = [user.id, user.sex, user.ageCat, user.profession, 
-                  user.citi, user.state]
-                fixedRating = [ rating.ratingCat]
- 
-                lst = fixedMovie[:]
-                lst.extend(fixedUser)
-                lst.extend(fixedRating)
-                lst.extend(cast)
-                lst.extend(genres)
-                lst = map(unicode, lst)
+    def __init__(self, filename, movieItems, userItems, ranking=None,
+      ratingItem=False, ratingYear=None, ratingMonth=None, ratingDates=None,
+      format="labels", mining=None, matrix=None, compression=None,
+      prune=None, sampler=None):
+        self.filename = filename
+        self.movieItems = movieItems
+        self.userItems = userItems
+        if ranking != None and not isinstance(ranking, (list, tuple)):
+            ranking = (ranking,)
+        self.ranking = ranking
+        self.ratingItem = ratingItem
+        self.ratingYear = ratingYear
+        self.bounds = period_bounds(ratingYear, ratingMonth, ratingDates)
+        if format not in ("labels", "ids"):
+            raise ValueError("Unknown output format %s" % format)
+        self.format = format
+        self.mining = mining
+        if matrix and not set(matrix) <= set(('npz', 'mtx')):
+            raise ValueError("Unknown matrix format %s" % ', '.join(matrix))
+        self.matrix = matrix
+        if compression not in (None, 'gzip', 'xz'):
+            raise ValueError("Unknown compression %s" % compression)
+        self.compression = compression
+        self.prune = prune
+        if prune and sampler:
+            raise ValueError("Sampled outputs can not be pruned")
+        self.sampler = sampler
+        self.keep = None
+        self.pruneStats = None
+        self.items = None
+        self.transactions = None
+        self.params = None
+        self.key = None
+        self.transid = 0
+        self.written = 0
+        self.nitems = 0
+        self.append = False
+        self.sink = None
+        self.userCache = {}
+        self.ratingCache = {}
+        self.itemLabels = None
+        self.seenUsers = None
+        self.prepared = None
+
+    def resume(self, transid):
+        """Append to the file of a previous run, whose last tid is transid"""
+        self.transid = transid
+        self.append = True
+
+    def open(self):
+        """Open the output file and write the header"""
+        if self.mining or self.matrix:
+            self.transactions = miner.TransactionSet()
+            self.itemLabels = {}
+        if self.filename is None:
+            return True
+        header = None
+        if not self.append:
+            header = 'tid,itemid' if self.format == "ids" else 'tid,pid'
+        self.sink = open_sink(self.filename, 'a' if self.append else 'w',
+          self.compression, header)
+        return self.sink is not None
+
+    def accepts(self, ratingCat):
+        """Return True if the rating category belongs to this output"""
+        return self.ranking == None or ratingCat in self.ranking
+
+    def select(self, ratings):
+        """Return the slices of the store with the ratings of a movie that
+        are inside the periods of this output"""
+        if self.bounds is None:
+            return [ratings.index]
+        return ratings.between(self.bounds)
+
+    def sample(self, movie, store, index):
+        """Return the userids and rating codes of the accepted ratings of a
+        slice of the store that the sampler keeps to write now"""
+        ratingCats = store.ratingCat[index]
+        keep = numpy.array([self.accepts(ratingCat)
+          for ratingCat in RATING_CATS])[ratingCats]
+        userids = store.userid[index][keep]
+        ratingCats = ratingCats[keep]
+        strata = self.sampler.strata(store, index, keep, userids, ratingCats)
+        selected = self.sampler.select(strata, movie, userids, ratingCats)
+        return userids[selected].tolist(), ratingCats[selected].tolist()
+
+    def seed(self, movie, userids, ratingCats, usersById):
+        """Assign the item ids of the transactions of a movie in the order
+        write would assign them
+
+        userids and ratingCats are the accepted ratings of the movie. The
+        ids outputs number the movie items when they are prepared, and the
+        mined outputs when they write the first transaction. Then only the
+        transactions of new users or new rating categories can have new
+        items, so only they are encoded.
+        """
+        (head, tail) = self.prepare(movie)
+        # Kept for the processes that write the transactions
+        if self.prepared is None:
+            self.prepared = {}
+        self.prepared[movie.id] = (head, tail)
+        if not len(userids):
+            return
+        if self.seenUsers is None:
+            self.seenUsers = numpy.zeros(max(usersById) + 1, dtype=bool)
+        positions = set([0] if self.itemLabels is not None else [])
+        news = numpy.flatnonzero(~self.seenUsers[userids])
+        if len(news):
+            (users, first) = numpy.unique(userids[news], return_index=True)
+            self.seenUsers[users] = True
+            positions.update(news[first].tolist())
+        if self.ratingItem and len(self.ratingCache) < len(RATING_CATS):
+            (cats, first) = numpy.unique(ratingCats, return_index=True)
+            for cat, position in zip(cats.tolist(), first.tolist()):
+                if RATING_CATS[cat] not in self.ratingCache:
+                    positions.add(position)
+        for position in sorted(positions):
+            lst = self.transaction(head, usersById[int(userids[position])],
+              RATING_CATS[ratingCats[position]], tail)
+            if self.itemLabels is not None:
                 for item in lst:
-                    fh.write(('%d,"%s"\n' %(transid, item)).encode('utf-8'))
+                    self.items.id(self.itemLabels[item])
+
+    def writeReservoir(self, usersById):
+        """Write the transactions kept by the reservoirs of the sampler"""
+        prepared = {}
+        for (movie, userid, cat) in self.sampler.reservoir():
+            items = prepared.get(movie.id)
+            if items is None:
+                items = prepared[movie.id] = self.prepare(movie)
+            self.write(items[0], usersById[userid], RATING_CATS[cat],
+              items[1])
+
+    def setSupport(self, support, ntrans):
+        """Keep only the items whose support reaches the prune minsup
+
+        support maps the item labels to the number of transactions that
+        contain them, out of ntrans.
+        """
+        minCount = max(1, int(numpy.ceil(self.prune * ntrans - 1e-9)))
+        self.keep = set(item for item, count in support.items()
+          if count >= minCount)
+        self.pruneStats = {
+            'minsup': self.prune,
+            'minCount': minCount,
+            'transactions': ntrans,
+            'items': len(support),
+            'keptItems': len(self.keep),
+            'occurrences': sum(support.values()),
+            'keptOccurrences': sum(support[item] for item in self.keep),
+            'emptyTransactions': 0,
+            }
+
+    def encode(self, items):
+        """Return the items as they are written after the tid: the encoded
+        "label" or the item id, and the end of line"""
+        encoded = []
+        for item in map(unicode, items):
+            if self.keep is not None and item not in self.keep:
+                continue
+            if self.format == "ids":
+                line = '%d\n' % self.items.id(item)
+            else:
+                line = (u'"%s"\n' % item).encode('utf-8')
+            if self.itemLabels is not None:
+                self.itemLabels[line] = item
+            encoded.append(line)
+        return encoded
+
+    def prepare(self, movie):
+        """Return the encoded (head, tail) items of a movie"""
+        if self.prepared is not None and movie.id in self.prepared:
+            return self.prepared[movie.id]
+        (head, tail) = self.movieItems(movie)
+        return self.encode(head), self.encode(tail)
+
+    def transaction(self, head, user, ratingCat, tail):
+        """Return the encoded items of a transaction"""
+        # The items of every user are encoded only once
+        userItems = self.userCache.get(user.id)
+        if userItems is None:
+            userItems = self.encode(self.userItems(user))
+            self.userCache[user.id] = userItems
+        lst = head + userItems
+        if self.ratingItem:
+            ratingItems = self.ratingCache.get(ratingCat)
+            if ratingItems is None:
+                ratingItems = self.encode([ratingCat])
+                self.ratingCache[ratingCat] = ratingItems
+            lst.extend(ratingItems)
+        lst.extend(tail)
+        return lst
+
+    def write(self, head, user, ratingCat, tail):
+        """Write a transaction"""
+        self.transid += 1
+        lst = self.transaction(head, user, ratingCat, tail)
+        self.written += 1
+        self.nitems += len(lst)
+        if not lst and self.pruneStats:
+            self.pruneStats['emptyTransactions'] += 1
+        if self.transactions is not None:
+            labels = self.itemLabels
+            self.transactions.add([self.items.id(labels[item])
+              for item in lst])
+        # A transaction whose items were all pruned has no line, but it is
+        # still counted by the supports and the mined transactions
+        if self.sink is None or not lst:
+            return
+        # All the lines of the transaction are built by a single join
+        prefix = '%d,' % self.transid
+        self.sink.write(prefix + prefix.join(lst), len(lst))
 
-    fh.close()
+    def close(self):
+        """Write the pending rows and close the file
 
+        Raises IOError if the rows could not be written.
+        """
+        rows = size = 0
+        sink = self.sink
+        self.sink = None
+        self.userCache = {}
+        self.ratingCache = {}
+        self.itemLabels = None
+        self.seenUsers = None
+        self.prepared = None
+        if sink:
+            sink.close()
+            (rows, size) = (sink.rows, sink.size)
+        metrics.output(self.filename, self.written, self.nitems, rows, size)
+        if self.pruneStats and self.filename:
+            fh = open(self.filename + '.prune.json', 'w')
+            try:
+                json.dump(self.pruneStats, fh, indent=1, sort_keys=True)
+            finally:
+                fh.close()
+
+    def writeMatrix(self):
+        """Write the incidence matrix of the collected transactions"""
+        write_matrix(self.filename, self.transactions, self.items,
+          self.matrix)
+
+    def mine(self):
+        """Mine the collected transactions and write the rules file"""
+        rules = miner.mine_rules(self.transactions,
+          self.mining.get('minsup', MINSUP),
+          self.mining.get('minconf', MINCONF),
+          self.mining.get('minlift'),
+          self.mining.get('maxlen', miner.MAXLEN))
+        miner.write_rules(self.mining['rules'], rules, self.items)
+
+
+
+def count_supports(outputs, moviesDict, usersById):
+    """First pass of the outputs with prune: count the item supports
+
+    Only the rating arrays are read. The movie items count the accepted
+    ratings of every movie, and the user and rating items the accepted
+    ratings of every user and category, gathered in arrays and counted
+    with bincount. An item that is both a movie and a user item gets the
+    sum of both, an upper bound, so no item above the minsup is pruned.
+    """
+    for output in outputs:
+        accepted = numpy.array([output.accepts(ratingCat)
+          for ratingCat in RATING_CATS])
+        support = collections.defaultdict(int)
+        userids = []
+        ratingCats = []
+        for movie in moviesDict.values():
+            if not (movie.rating and movie.imdbRating):
+                continue
+            store = movie.rating.store
+            count = 0
+            for index in output.select(movie.rating):
+                cats = store.ratingCat[index]
+                keep = accepted[cats]
+                userids.append(store.userid[index][keep])
+                ratingCats.append(cats[keep])
+                count += len(userids[-1])
+            if count:
+                (head, tail) = output.movieItems(movie)
+                for item in set(map(unicode, head + tail)):
+                    support[item] += count
+
+        userids = numpy.concatenate(userids) if userids else \
+          numpy.zeros(0, dtype=numpy.int32)
+        userCounts = numpy.bincount(userids)
+        for userid in numpy.flatnonzero(userCounts).tolist():
+            for item in set(map(unicode, output.userItems(usersById[userid]))):
+                support[item] += int(userCounts[userid])
+        if output.ratingItem and ratingCats:
+            catCounts = numpy.bincount(numpy.concatenate(ratingCats),
+              minlength=len(RATING_CATS))
+            for ratingCat, count in zip(RATING_CATS, catCounts.tolist()):
+                if count:
+                    support[unicode(ratingCat)] += count
+        output.setSupport(support, len(userids))
+
+
+def _write_movie(movie, outputs, usersById):
+    """Write the transactions of the ratings of a movie"""
+    store = movie.rating.store
+    for output in outputs:
+        # Only the periods of the output are read
+        slices = output.select(movie.rating)
+        if not slices:
+            continue
+        # The movie items are built once per output
+        (head, tail) = output.prepare(movie)
+        for index in slices:
+            if output.sampler:
+                (userids, ratingCats) = output.sample(movie, store, index)
+            else:
+                userids = store.userid[index].tolist()
+                ratingCats = store.ratingCat[index].tolist()
+            for userid, cat in zip(userids, ratingCats):
+                ratingCat = RATING_CATS[cat]
+                if output.accepts(ratingCat):
+                    output.write(head, usersById[userid], ratingCat, tail)
+
+
+def seed_items(outputs, movies, usersById):
+    """Assign the item ids of all the transactions of the outputs in the
+    order of a serial run, see TransactionOutput.seed"""
+    accepted = dict((output, numpy.array([output.accepts(ratingCat)
+      for ratingCat in RATING_CATS])) for output in outputs)
+    for movie in movies:
+        store = movie.rating.store
+        for output in outputs:
+            slices = output.select(movie.rating)
+            if not slices:
+                continue
+            ratingCats = numpy.concatenate([store.ratingCat[index]
+              for index in slices])
+            userids = numpy.concatenate([store.userid[index]
+              for index in slices])
+            keep = accepted[output][ratingCats]
+            output.seed(movie, userids[keep], ratingCats[keep], usersById)
+
+
+def referenced_movies(outputs, moviesDict):
+    """Return the movies with ratings that reach one of the outputs
+
+    Only these movies need the IMDB information: the writers skip the rest.
+    """
+    movies = [movie for movie in moviesDict.values() if movie.rating]
+    if not movies:
+        return []
+    referenced = numpy.zeros(len(movies), dtype=bool)
+    for output in outputs:
+        referenced |= transaction_counts(output, movies) > 0
+    return [movie for movie, keep in zip(movies, referenced.tolist()) if keep]
 
-def writeTransActorsDirectors(filename, moviesDict, usersDict, ranking="high", 
-  writeGenre=False, ratingYear=None):
-    """Write a transaction file ready to be process by R.
 
-    The file will write """
-    CSV_CHAR = ','
-    # Open the File
+def transaction_counts(output, movies):
+    """Return the number of transactions of an output for every movie"""
+    store = movies[0].rating.store
+    keep = numpy.array([output.accepts(ratingCat)
+      for ratingCat in RATING_CATS])[store.ratingCat]
+    if output.bounds is not None:
+        keep &= numpy.searchsorted(output.bounds, store.timestamp,
+          side='right') % 2 == 1
+    totals = numpy.concatenate(([0], numpy.cumsum(keep)))
+    starts = numpy.array([movie.rating.index.start for movie in movies])
+    stops = numpy.array([movie.rating.index.stop for movie in movies])
+    return totals[stops] - totals[starts]
+
+
+# Outputs, movies, users and profile file of write_shards, inherited by the
+# processes
+_shardState = None
+
+
+def _shard_filename(output, index):
+    return '%s.shard%03d' % (output.filename, index)
+
+
+def _shard_profile(profile, index):
+    return '%s.shard%03d' % (profile, index)
+
+
+def _write_shard(shard):
+    """Write the transactions of a shard of movies to shard files
+
+    Returns the (written, nitems, rows, emptyTransactions, error) of every
+    output, error being the message of a shard file that could not be
+    written. With a profile file, the cProfile stats of the shard are dumped next to
+    it.
+    """
+    (index, start, stop, offsets) = shard
+    (outputs, movies, usersById, profile) = _shardState
+    if profile:
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(_write_shard_movies, index, start, stop,
+              offsets, outputs, movies, usersById)
+        finally:
+            profiler.dump_stats(_shard_profile(profile, index))
+    return _write_shard_movies(index, start, stop, offsets, outputs, movies,
+      usersById)
+
+
+def _write_shard_movies(index, start, stop, offsets, outputs, movies,
+  usersById):
+    nlabels = len(outputs[0].items.labels)
+    errors = {}
+    for output, offset in zip(outputs, offsets):
+        output.transid = offset
+        output.written = output.nitems = 0
+        if output.pruneStats:
+            output.pruneStats['emptyTransactions'] = 0
+        try:
+            output.sink = TransactionSink(_shard_filename(output, index))
+        except (IOError, OSError) as e:
+            output.sink = None
+            errors[output] = str(e)
+    for movie in movies[start:stop]:
+        _write_movie(movie, outputs, usersById)
+    results = []
+    for output in outputs:
+        rows = 0
+        if output.sink:
+            try:
+                output.sink.close()
+            except IOError as e:
+                errors[output] = str(e)
+            rows = output.sink.rows
+        results.append((output.written, output.nitems, rows,
+          output.pruneStats['emptyTransactions'] if output.pruneStats else 0,
+          errors.get(output)))
+    if len(outputs[0].items.labels) != nlabels:
+        raise RuntimeError("Shard %d found items that were not seeded" % index)
+    return results
+
+
+def write_shards(outputs, movies, usersById, workers, profile=None):
+    """Write the transactions of the outputs with a pool of processes
+
+    The movies are split in contiguous shards with about the same number
+    of transactions. The tids of every shard start at the number of
+    transactions of the previous shards, and the items are already seeded,
+    so every process writes the lines of a serial run to its shard files,
+    which are then appended in order to the output files.
+    With a profile file, every shard is profiled and their stats are merged
+    into it. Returns the outputs whose shards could not be written.
+    """
+    global _shardState
+    counts = dict((output, transaction_counts(output, movies))
+      for output in outputs)
+    work = numpy.cumsum(sum(counts[output] for output in outputs))
+    nshards = max(1, min(len(movies), workers * SHARDS_PER_WORKER))
+    edges = numpy.searchsorted(work, numpy.arange(1, nshards) *
+      float(work[-1]) / nshards, side='right')
+    edges = sorted(set([0, len(movies)] + edges.tolist()))
+    starts = dict((output, numpy.concatenate(([0], numpy.cumsum(
+      counts[output]))) + output.transid) for output in outputs)
+    shards = [(index, start, stop, [int(starts[output][start])
+      for output in outputs])
+      for index, (start, stop) in enumerate(zip(edges[:-1], edges[1:]))]
+
+    _shardState = (outputs, movies, usersById, profile)
+    pool = multiprocessing.Pool(workers)
     try:
-        fh = open(filename, 'w')
+        results = pool.map(_write_shard, shards, chunksize=1)
+        pool.close()
     except:
-        return None
+        pool.terminate()
+        for output in outputs:
+            for shard in shards:
+                if os.path.isfile(_shard_filename(output, shard[0])):
+                    os.remove(_shard_filename(output, shard[0]))
+        raise
+    finally:
+        pool.join()
+        _shardState = None
+        if profile:
+            profiles = [_shard_profile(profile, shard[0]) for shard in shards]
+            profiles = [filename for filename in profiles
+              if os.path.isfile(filename)]
+            if profiles:
+                stats = pstats.Stats(*profiles)
+                if os.path.isfile(profile):
+                    stats.add(profile)
+                stats.dump_stats(profile)
+            for filename in profiles:
+                os.remove(filename)
+
+    failed = []
+    for i, output in enumerate(outputs):
+        errors = [result[i][4] for result in results if result[i][4]]
+        if errors:
+            print("Error writing %s: %s" % (output.filename, errors[0]))
+            failed.append(output)
+            for shard in shards:
+                if os.path.isfile(_shard_filename(output, shard[0])):
+                    os.remove(_shard_filename(output, shard[0]))
+            continue
+        for shard, result in zip(shards, results):
+            (written, nitems, rows, empty, error) = result[i]
+            filename = _shard_filename(output, shard[0])
+            fh = open(filename, 'rb')
+            try:
+                while True:
+                    data = fh.read(SINK_BUFFER)
+                    if not data:
+                        break
+                    output.sink.write(data, 0)
+            finally:
+                fh.close()
+            os.remove(filename)
+            output.sink.rows += rows
+            output.written += written
+            output.nitems += nitems
+            if output.pruneStats:
+                output.pruneStats['emptyTransactions'] += empty
+        output.transid = int(starts[output][-1])
+    return failed
+
+
+def write_transactions(outputs, moviesDict, usersDict, itemsFile=None,
+  itemDictionary=None, workers=1, profile=None):
+    """Write several transaction files in a single pass over the ratings
+
+    Movies are walked only once. For every movie, each output reads only the
+    ratings of its periods and keeps those whose category matches. Outputs
+    that can not be opened are skipped, and the ones that can not be
+    written are reported: the outputs written are returned.
+    The outputs with the "ids" format share an ItemDictionary, which is
+    written to itemsFile when one of them is written. The mining and matrix
+    outputs number their items in it too, but write their own labels.
+    itemDictionary is the dictionary of a previous
+    run, when the outputs are resumed. The outputs with mining parameters
+    keep their transactions in memory and write their rules at the end.
+    The outputs with prune get their item supports from a first pass.
+    With several workers, the outputs written to files are written by a
+    pool of processes, see write_shards, while the mining and matrix
+    outputs are written by this process. Sampled outputs can only be
+    written serially. profile is the file where the cProfile stats of the
+    processes are merged.
+    """
+    outputs = [output for output in outputs if output.open()]
+    if not outputs:
+        return []
+    usersById = dict((int(userid), user) for userid, user in usersDict.items())
+    if itemDictionary is None:
+        itemDictionary = ItemDictionary()
+    for output in outputs:
+        output.items = itemDictionary
+    pruned = [output for output in outputs if output.prune]
+    if pruned:
+        with metrics.stage('count_supports'):
+            count_supports(pruned, moviesDict, usersById)
+    for output in outputs:
+        if output.sampler:
+            output.sampler.start(usersById)
+    movies = [movie for movie in moviesDict.values()
+      if movie.rating and movie.imdbRating]
+
+    serial = outputs
+    failed = []
+    if workers > 1 and any(output.sampler for output in outputs):
+        print("Sampled outputs can not be sharded, writing serially")
+    elif workers > 1 and movies:
+        # Only the ids outputs and the mined outputs number the items
+        with metrics.stage('seed_items'):
+            seed_items([output for output in outputs if
+              output.format == "ids" or output.itemLabels is not None],
+              movies, usersById)
+        parallel = [output for output in outputs if output.filename and
+          not (output.mining or output.matrix)]
+        serial = [output for output in outputs if output not in parallel]
+        if parallel:
+            with metrics.stage('write_shards'):
+                failed = write_shards(parallel, movies, usersById, workers,
+                  profile)
+
+    if serial:
+        for movie in movies:
+            _write_movie(movie, serial, usersById)
+
+    for output in outputs:
+        try:
+            if output.sampler and output.sampler.size:
+                output.writeReservoir(usersById)
+            output.close()
+            if output not in failed:
+                if output.matrix and output.filename:
+                    output.writeMatrix()
+                if output.mining:
+                    output.mine()
+        except IOError as e:
+            print(e)
+            failed.append(output)
+        output.transactions = None
+    idsOutputs = [output for output in outputs
+      if output.format == "ids" and output not in failed]
+    if itemsFile and itemDictionary.labels and idsOutputs:
+        try:
+            itemDictionary.write(itemsFile)
+        except IOError as e:
+            # The ids of the ids outputs are lost
+            print(e)
+            failed.extend(idsOutputs)
+    return [output for output in outputs if output not in failed]
 
-    # Write the header
-    header = ['tid', 'pid']
-    line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
-    
-    transid = 0
-    for movie in moviesDict.values():
-        if movie.rating and movie.imdbRating:
-            cast = map((lambda x: "actor_" + x), movie.cast) if movie.cast else ['?']
-            genres = movie.genre if movie.genre else ['?']
-            
-            if movie.director:
-                fixedMovie = [movie.name, "director_" + movie.director ]
-            else:
-                fixedMovie = [movie.name]
-            
-            for rating in movie.rating:
-                if ranking == None or rating.ratingCat == ranking:
-                    currentRatingYear = int(datetime.datetime.fromtimestamp(int(rating.timestamp)).strftime('%Y'))
-                    if ratingYear==None or currentRatingYear in ratingYear:
-                        transid += 1
-                        user = usersDict[rating.userid]
-                        fixedUser = [user.ageCat, "prof_" + user.profession]
-                        fixedRating = [ rating.ratingCat ]
-     
-                        lst = fixedMovie[:]
-                        lst.extend(fixedUser)
-                        if ranking == None:
-                            lst.extend(fixedRating)
-                        lst.extend(cast)
-                        if writeGenre:
-                            lst.extend(map((lambda x: "genre_" + x), genres))
-                        lst = map(unicode, lst)
-                        for item in lst:
-                            fh.write(('%d,"%s"\n' %(transid, item)).encode('utf-8'))
 
-    fh.close()
 
+def _castItems(movie, prefix=""):
+    return [prefix + actor for actor in movie.cast] if movie.cast else ['?']
 
-def writeTransDirectors(filename, moviesDict, usersDict, ranking="high", writeGenre=False):
+
+def _genreItems(movie, prefix=""):
+    genres = movie.genre if movie.genre else ['?']
+    return [prefix + genre for genre in genres]
+
+
+def transActorDirectorsOutput(filename, format="labels"):
+    """Output with the movie, the user, the rating, the cast and the genres"""
+
+    def movieItems(movie):
+        head = [movie.name, movie.yearCat, movie.director]
+        return head, _castItems(movie) + _genreItems(movie)
+
+    def userItems(user):
+        return [user.id, user.sex, user.ageCat, user.profession, user.citi,
+          user.state]
+
+    return TransactionOutput(filename, movieItems, userItems,
+      ratingItem=True, format=format)
+
+
+def transActorsDirectorsOutput(filename, ranking="high", writeGenre=False,
+  ratingYear=None, format="labels"):
+    """Output with the movie, the director, the user age and profession,
+    the cast and optionally the genres"""
+
+    def movieItems(movie):
+        head = [movie.name]
+        if movie.director:
+            head.append("director_" + movie.director)
+        tail = _castItems(movie, "actor_")
+        if writeGenre:
+            tail.extend(_genreItems(movie, "genre_"))
+        return head, tail
+
+    def userItems(user):
+        return [user.ageCat, "prof_" + user.profession]
+
+    return TransactionOutput(filename, movieItems, userItems, ranking=ranking,
+      ratingItem=ranking == None, ratingYear=ratingYear,
+      format=format)
+
+
+def transDirectorsOutput(filename, ranking="high", writeGenre=False,
+  format="labels"):
+    """Output with the movie, the director, the user age and profession
+    and optionally the genres"""
+
+    def movieItems(movie):
+        head = [movie.name]
+        if movie.director:
+            head.append("director_" + movie.director)
+        return head, _genreItems(movie) if writeGenre else []
+
+    def userItems(user):
+        return [user.ageCat, "prof_" + user.profession]
+
+    return TransactionOutput(filename, movieItems, userItems, ranking=ranking,
+      ratingItem=ranking == None,
+      format=format)
+
+
+def locationOutput(filename, ranking="high", citi=True, state=True,
+  director=True, writeGenre=False, format="labels"):
+    """Output with the movie, the director and the user location"""
+
+    def movieItems(movie):
+        head = [movie.name]
+        if movie.director and director:
+            head.append("director_" + movie.director)
+        return head, _genreItems(movie) if writeGenre else []
+
+    def userItems(user):
+        items = []
+        if citi:    items.append(user.citi)
+        if state:   items.append(user.state)
+        return items
+
+    return TransactionOutput(filename, movieItems, userItems, ranking=ranking,
+      ratingItem=ranking == None,
+      format=format)
+
+
+def onlyActorsDirectorsOutput(filename, ranking=None, actors=True,
+  directors=True, format="labels"):
+    """Output with the rating and the director and/or the cast"""
+
+    def movieItems(movie):
+        head = []
+        if directors and movie.director:
+            head.append("director_" + movie.director)
+        return head, _castItems(movie, "actor_") if actors else []
+
+    def userItems(user):
+        return []
+
+    return TransactionOutput(filename, movieItems, userItems, ranking=ranking,
+      ratingItem=True,
+      format=format)
+
+
+def alejoOutput(filename, ranking="high", writeGenre=False, ratingYear=None,
+  format="labels"):
+    """Output with the movie, the director, the full user profile, the cast
+    and optionally the genres"""
+
+    def movieItems(movie):
+        head = [movie.name]
+        if movie.director:
+            head.append("director_" + movie.director)
+        tail = _castItems(movie, "actor_")
+        if writeGenre:
+            tail.extend(_genreItems(movie, "genre_"))
+        return head, tail
+
+    def userItems(user):
+        return [user.ageCat, "prof_" + user.profession, user.citi, user.state,
+          user.sex]
+
+    return TransactionOutput(filename, movieItems, userItems, ranking=ranking,
+      ratingItem=ranking == None, ratingYear=ratingYear,
+      format=format)
+
+
+
+# Items of the fields a dataset spec can use
+MOVIE_FIELDS = {
+    'id': lambda movie, prefix: [prefix + movie.id],
+    'name': lambda movie, prefix: [prefix + movie.name],
+    'yearCat': lambda movie, prefix:
+      [prefix + movie.yearCat] if movie.yearCat else [],
+    'director': lambda movie, prefix:
+      [prefix + movie.director] if movie.director else [],
+    'cast': _castItems,
+    'genre': _genreItems,
+    'tag': lambda movie, prefix:
+      [prefix + tag for tag in movie.tags] if movie.tags else [],
+    }
+USER_FIELDS = {
+    'id': lambda user, prefix: [prefix + user.id],
+    'sex': lambda user, prefix: [prefix + user.sex],
+    'ageCat': lambda user, prefix: [prefix + user.ageCat],
+    'profession': lambda user, prefix: [prefix + user.profession],
+    # Users without postcode have no city or state, written as "None"
+    'citi': lambda user, prefix: [prefix + unicode(user.citi)],
+    'state': lambda user, prefix: [prefix + unicode(user.state)],
+    }
+# Movie fields that get no item when the movie lacks them, or the missing
+# item of the spec
+OPTIONAL_FIELDS = ('yearCat', 'director')
+# Prefixes of the items when a dataset spec has prefix: true
+PREFIXES = {'director': 'director_', 'cast': 'actor_', 'genre': 'genre_',
+  'tag': 'tag_', 'profession': 'prof_'}
+
+
+def _years(years):
+    """Return the list of years of a spec: a list or a {from, to} range"""
+    if isinstance(years, dict):
+        return range(years['from'], years['to'] + 1)
+    return list(years)
+
+
+def _months(months):
+    """Return the (year, month) of the "YYYY-MM" strings of a spec"""
+    return [tuple(int(value) for value in str(month).split('-'))
+      for month in months]
+
+
+def _fieldItems(fields, table, prefixes, missing=None):
+    """Return a function that returns the items of the fields of a spec
+
+    The optional fields without value get the missing item, if any.
+    """
+    for field in fields:
+        if field not in table:
+            raise ValueError("Unknown field %s" % field)
+    functions = [(table[field], unicode(prefixes.get(field, '')),
+      missing is not None and field in OPTIONAL_FIELDS) for field in fields]
+
+    def items(obj):
+        lst = []
+        for function, prefix, optional in functions:
+            values = function(obj, prefix)
+            if not values and optional:
+                values = [prefix + unicode(missing)]
+            lst.extend(values)
+        return lst
+
+    return items
+
+
+def datasetOutput(filename, spec, format="labels", compression=None):
+    """Output defined by a dataset spec of the config file
+
+    The spec fields are:
+     * head, user, tail: movie fields before the user items, user fields
+        and movie fields after the rating item. Movie fields are id, name,
+        yearCat, director, cast, genre and tag (see load_tags); user fields
+        are id, sex, ageCat, profession, citi and state
+     * rating: rating category (or list of categories) to keep, null for all
+     * ratingItem: write the rating category, by default when rating is null
+     * years: list of years, or {from, to}; months: list of "YYYY-MM";
+        dates: list of [first, last] dates, last excluded
+     * prefix: true to prefix the director, cast, genre, tag and
+        profession items as the writers do, false, or a {field: prefix}
+        mapping
+     * missing: item of the movies without yearCat or director, which get
+        no item by default
+     * format: labels or ids, by default the output format
+     * matrix: list of incidence matrix files to write, npz and/or mtx
+     * compression: gzip or xz, by default the output compression
+     * prune: minimum support of the written items, true for the minsup
+        of the mining parameters
+     * sample: {size, fraction, by, seed} parameters of a Sampler
+    """
+    prefix = spec.get('prefix', True)
+    if prefix is True:
+        prefixes = PREFIXES
+    elif not prefix:
+        prefixes = {}
+    else:
+        prefixes = prefix
+    head = _fieldItems(spec.get('head', ['name', 'director']), MOVIE_FIELDS,
+      prefixes, spec.get('missing'))
+    tail = _fieldItems(spec.get('tail', []), MOVIE_FIELDS, prefixes,
+      spec.get('missing'))
+
+    def movieItems(movie):
+        return head(movie), tail(movie)
+
+    ranking = spec.get('rating')
+    return TransactionOutput(filename, movieItems,
+      _fieldItems(spec.get('user', []), USER_FIELDS, prefixes),
+      ranking=ranking, ratingItem=spec.get('ratingItem', ranking == None),
+      ratingYear=_years(spec['years']) if 'years' in spec else None,
+      ratingMonth=_months(spec['months']) if 'months' in spec else None,
+      ratingDates=spec.get('dates'),
+      format=spec.get('format', format), matrix=spec.get('matrix'),
+      compression=spec.get('compression', compression),
+      prune=spec.get('prune'),
+      sampler=Sampler(**spec['sample']) if spec.get('sample') else None)
+
+
+def dataset_outputs(datasets, basePath, format="labels", mining=None,
+  compression=None):
+    """Return the outputs of the enabled dataset specs of the config file
+
+    The params of every output hash its spec. Compressed outputs get the
+    .gz or .xz suffix.
+    """
+    outputs = []
+    for name in sorted(datasets):
+        spec = datasets[name]
+        if not spec.get('enabled', True):
+            continue
+        filename = "%s/%s" % (basePath, spec.get('file', name + '.csv'))
+        suffix = COMPRESSION_SUFFIXES.get(spec.get('compression', compression))
+        if suffix and not filename.endswith(suffix):
+            filename += suffix
+        output = datasetOutput(filename, spec, format, compression)
+        if mining:
+            output.mining = dict(mining, rules=filename + '.rules.csv')
+        if output.prune is True:
+            output.prune = (mining or {}).get('minsup', MINSUP)
+        output.params = hashlib.sha1(json.dumps([spec, format, mining,
+          compression], sort_keys=True, default=str)).hexdigest()
+        outputs.append(output)
+    return outputs
+
+
+
+def writeTransActorDirectors(filename, moviesDict, usersDict):
     """Write a transaction file ready to be process by R.
 
-    The file will write """
-    CSV_CHAR = ','
-    # Open the File
-    try:
-        fh = open(filename, 'w')
-    except:
-        return None
+    It will write all the processed items on the target"""
+    return write_transactions([transActorDirectorsOutput(filename)],
+      moviesDict, usersDict)
 
-    # Write the header
-    header = ['tid', 'pid']
-    line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
-    
-    transid = 0
-    for movie in moviesDict.values():
-        if movie.rating and movie.imdbRating:
-            genres = movie.genre if movie.genre else ['?']
-            if movie.director:
-                fixedMovie = [movie.name, "director_" + movie.director]
-            else:
-                fixedMovie = [movie.name]
 
-            for rating in movie.rating:
-                if ranking == None or rating.ratingCat == ranking:
-                    transid += 1
-                    user = usersDict[rating.userid]
-                    fixedUser = [user.ageCat, "prof_" + user.profession]
-                    fixedRating = [ rating.ratingCat ]
-     
-                    lst = fixedMovie[:]
-                    lst.extend(fixedUser)
-                    if ranking == None: 
-                        lst.extend(fixedRating)
-                    if writeGenre:
-                        lst.extend(genres)
-                    lst = map(unicode, lst)
-                    for item in lst:
-                        fh.write(('%d,"%s"\n' %(transid, item)).encode('utf-8'))
 
-    fh.close()
+def writeOutputLikes5(filename, moviesDict, usersDict):
+    """Write a transaction file ready to be process by R.
 
+    It will write all the processed items on the target"""
+    return write_transactions([transActorDirectorsOutput(filename)],
+      moviesDict, usersDict)
 
 
-def writeLocationMovie(filename, moviesDict, usersDict, ranking="high", citi=True, state=True, director=True):
-    CSV_CHAR = ','
-    # Open the File
-    try:
-        fh = open(filename, 'w')
-    except:
-        return None
+def writeTransActorsDirectors(filename, moviesDict, usersDict, ranking="high", 
+  writeGenre=False, ratingYear=None):
+    """Write a transaction file ready to be process by R.
 
-    # Write the header
-    header = ['tid', 'pid']
-    line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
-    
-    transid = 0
-    for movie in moviesDict.values():
-        if movie.rating and movie.imdbRating:
-            genres = movie.genre if movie.genre else ['?']
-            if movie.director and director:
-                fixedMovie = [movie.name, "director_" + movie.director]
-            else:
-                fixedMovie = [movie.name]
+    The file will write """
+    return write_transactions([transActorsDirectorsOutput(filename, ranking,
+      writeGenre, ratingYear)], moviesDict, usersDict)
 
-            for rating in movie.rating:
-                if ranking == None or rating.ratingCat == ranking:
-                    transid += 1
-                    user = usersDict[rating.userid]
-                    fixedUser = []
-                    if citi:    fixedUser.append(user.citi)
-                    if state:   fixedUser.append(user.state)
-                    fixedRating = [ rating.ratingCat ]
-     
-                    lst = fixedMovie[:]
-                    lst.extend(fixedUser)
-                    if ranking == None: 
-                        lst.extend(fixedRating)
-#                    if writeGenre:
-#                        lst.extend(genres)
-                    lst = map(unicode, lst)
-                    for item in lst:
-                        fh.write(('%d,"%s"\n' %(transid, item)).encode('utf-8'))
 
-    fh.close()
+def writeTransDirectors(filename, moviesDict, usersDict, ranking="high", writeGenre=False):
+    """Write a transaction file ready to be process by R.
 
+    The file will write """
+    return write_transactions([transDirectorsOutput(filename, ranking,
+      writeGenre)], moviesDict, usersDict)
 
 
-def writeLocationGenre(filename, moviesDict, usersDict, ranking="high", citi=True, state=True, director=True):
-    CSV_CHAR = ','
-    # Open the File
-    try:
-        fh = open(filename, 'w')
-    except:
-        return None
 
-    # Write the header
-    header = ['tid', 'pid']
-    line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
-    
-    transid = 0
-    for movie in moviesDict.values():
-        if movie.rating and movie.imdbRating:
-            genres = movie.genre if movie.genre else ['?']
-            if movie.director and director:
-                fixedMovie = [movie.name, "director_" + movie.director]
-            else:
-                fixedMovie = [movie.name]
+def writeLocationMovie(filename, moviesDict, usersDict, ranking="high", citi=True, state=True, director=True):
+    return write_transactions([locationOutput(filename, ranking, citi, state,
+      director)], moviesDict, usersDict)
 
-            for rating in movie.rating:
-                if ranking == None or rating.ratingCat == ranking:
-                    transid += 1
-                    user = usersDict[rating.userid]
-                    fixedUser = []
-                    if citi:    fixedUser.append(user.citi)
-                    if state:   fixedUser.append(user.state)
-                    fixedRating = [ rating.ratingCat ]
-     
-                    lst = fixedMovie[:]
-                    lst.extend(fixedUser)
-                    if ranking == None: 
-                        lst.extend(fixedRating)
-                    lst.extend(genres)
-                    lst = map(unicode, lst)
-                    for item in lst:
-                        fh.write(('%d,"%s"\n' %(transid, item)).encode('utf-8'))
 
-    fh.close()
+
+def writeLocationGenre(filename, moviesDict, usersDict, ranking="high", citi=True, state=True, director=True):
+    return write_transactions([locationOutput(filename, ranking, citi, state,
+      director, writeGenre=True)], moviesDict, usersDict)
 
 
 
@@ -934,44 +3141,8 @@ def writeOnlyActorsDirectors(filename, moviesDict, usersDict, ranking=None,
     """Write a transaction file ready to be process by R.
 
     The file will write """
-    CSV_CHAR = ','
-    # Open the File
-    try:
-        fh = open(filename, 'w')
-    except:
-        return None
-
-    # Write the header
-    header = ['tid', 'pid']
-    line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
-    
-    transid = 0
-    for movie in moviesDict.values():
-        if movie.rating and movie.imdbRating:
-            cast = map((lambda x: "actor_" + x), movie.cast) if movie.cast else ['?']
-            
-            if directors and movie.director:
-                fixedMovie = ["director_" + movie.director ]
-            else:
-                fixedMovie = []
-            
-            for rating in movie.rating:
-                if ranking == None or rating.ratingCat in ranking:
-                    transid += 1
-                    user = usersDict[rating.userid]
-                    fixedRating = [ rating.ratingCat ]
-     
-                    lst = fixedMovie[:]
-                    lst.extend(fixedRating)
-                    if actors:
-                        lst.extend(cast)
-                    lst = map(unicode, lst)
-                    for item in lst:
-                        fh.write(('%d,"%s"\n' %(transid, item)).encode('utf-8'))
-
-    fh.close()
+    return write_transactions([onlyActorsDirectorsOutput(filename, ranking,
+      actors, directors)], moviesDict, usersDict)
 
 
 
@@ -980,59 +3151,372 @@ def alejo(filename, moviesDict, usersDict, ranking="high",
     """Write a transaction file ready to be process by R.
 
     The file will write """
-    CSV_CHAR = ','
-    # Open the File
+    return write_transactions([alejoOutput(filename, ranking, writeGenre,
+      ratingYear)], moviesDict, usersDict)
+
+
+
+def complete_size(filename):
+    """Return the size of a file up to the end of its last whole line
+
+    A line being appended to the file is left for the next run.
+    """
+    fh = open(filename, 'rb')
     try:
-        fh = open(filename, 'w')
-    except:
-        return None
+        fh.seek(0, os.SEEK_END)
+        size = fh.tell()
+        while size > 0:
+            start = max(0, size - BLOCK_SIZE)
+            fh.seek(start)
+            block = fh.read(size - start)
+            end = block.rfind(b'\n')
+            if end >= 0:
+                return start + end + 1
+            size = start
+    finally:
+        fh.close()
+    return 0
 
-    # Write the header
-    header = ['tid', 'pid']
-    line = CSV_CHAR.join(header)
-    fh.write(line.encode('utf-8'))
-    fh.write('\n')
-    
-    transid = 0
-    for movie in moviesDict.values():
-        if movie.rating and movie.imdbRating:
-            cast = map((lambda x: "actor_" + x), movie.cast) if movie.cast else ['?']
-            genres = movie.genre if movie.genre else ['?']
-            
-            if movie.director:
-                fixedMovie = [movie.name, "director_" + movie.director ]
-            else:
-                fixedMovie = [movie.name]
-            
-            for rating in movie.rating:
-                if ranking == None or rating.ratingCat == ranking:
-                    currentRatingYear = int(datetime.datetime.fromtimestamp(int(rating.timestamp)).strftime('%Y'))
-                    if ratingYear==None or currentRatingYear in ratingYear:
-                        transid += 1
-                        user = usersDict[rating.userid]
-                        fixedUser = [user.ageCat, "prof_" + user.profession, user.citi, user.state, user.sex]
-                        fixedRating = [ rating.ratingCat ]
-     
-                        lst = fixedMovie[:]
-                        lst.extend(fixedUser)
-                        if ranking == None:
-                            lst.extend(fixedRating)
-                        lst.extend(cast)
-                        if writeGenre:
-                            lst.extend(map((lambda x: "genre_" + x), genres))
-                        lst = map(unicode, lst)
-                        for item in lst:
-                            fh.write(('%d,"%s"\n' %(transid, item)).encode('utf-8'))
 
-    fh.close()
+def file_fingerprint(filename, size=None):
+    """Return the size and the hash of the first size bytes of a file
+
+    Large files are not hashed whole: only their first and last
+    FINGERPRINT_SAMPLE bytes and their size are.
+    """
+    if size is None:
+        size = os.path.getsize(filename)
+    digest = hashlib.sha1(str(size))
+    fh = open(filename, 'rb')
+    try:
+        if size <= 2 * FINGERPRINT_SAMPLE:
+            digest.update(fh.read(size))
+        else:
+            digest.update(fh.read(FINGERPRINT_SAMPLE))
+            fh.seek(size - FINGERPRINT_SAMPLE)
+            digest.update(fh.read(FINGERPRINT_SAMPLE))
+    finally:
+        fh.close()
+    return {'size': size, 'hash': digest.hexdigest()}
+
+
+def movies_digest(moviesDict, cache):
+    """Return a hash of the IMDB information of the movies in the cache
+
+    The information is read from the cache, so the hash does not depend on
+    the movies already enriched.
+    """
+    digest = hashlib.sha1()
+    for movieid in sorted(moviesDict, key=int):
+        entry = [movieid]
+        if movieid in cache:
+            entry.extend(cache[movieid])
+        else:
+            entry.extend([None] * len(ImdbEntry._fields))
+        entry.append(moviesDict[movieid].genre)
+        digest.update(json.dumps(entry))
+    return digest.hexdigest()
+
+
+def users_digest(usersDict):
+    """Return a hash of the resolved location of the users"""
+    digest = hashlib.sha1()
+    for userid in sorted(usersDict, key=int):
+        user = usersDict[userid]
+        digest.update(json.dumps([userid, user.citi, user.state]))
+    return digest.hexdigest()
+
+
+class Manifest:
+    """State of the last run, for the incremental mode
+
+    The manifest is a JSON file with:
+     * inputs: fingerprint of the movies and users files, and of the part
+        of the ratings file already processed
+     * caches: hashes of the IMDB information and of the user locations
+        that the transactions were built with
+     * outputs: last transaction id, size, format, parameters hash and key
+        of every output file. The key hashes the parameters and the state
+        of the inputs and caches the output was built from
+    An output whose key did not change is up to date. A run can resume the
+    outputs when the movies, users and caches did not change, the ratings
+    file only grew and the outputs and their parameters were not modified.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.state = None
+        if os.path.isfile(filename):
+            fh = open(filename, 'r')
+            try:
+                self.state = json.load(fh)
+            except ValueError:
+                self.state = None
+            finally:
+                fh.close()
+
+    def entry(self, output):
+        """Return the recorded state of an output, or None"""
+        if not self.state:
+            return None
+        entry = self.state['outputs'].get(output.filename)
+        if entry is None or not os.path.isfile(output.filename) or \
+          os.path.getsize(output.filename) != entry['size']:
+            return None
+        return entry
+
+    def upToDate(self, output):
+        """Return True if the output file was built with the same key"""
+        entry = self.entry(output)
+        return entry is not None and output.key is not None and \
+          entry.get('key') == output.key
+
+    def resume(self, inputs, caches, ratingFile, outputs):
+        """Return the offset of the new ratings, or 0 for a full run
+
+        inputs and caches are the state of the current run. When the
+        outputs can be resumed, they are set to append after their last
+        transaction.
+        """
+        state = self.state
+        if not state:
+            print("No manifest, full run")
+            return 0
+        if state['inputs']['movie'] != inputs['movie'] or \
+          state['inputs']['user'] != inputs['user'] or \
+          state['inputs'].get('tag') != inputs.get('tag'):
+            print("Movies, users or tags changed, full run")
+            return 0
+        if state['caches'] != caches:
+            print("IMDB information or user locations changed, full run")
+            return 0
+        rating = state['inputs']['rating']
+        if inputs['rating'].get('compression'):
+            print("Compressed ratings file, full run")
+            return 0
+        if rating['size'] > inputs['rating']['size'] or \
+          file_fingerprint(ratingFile, rating['size']) != rating:
+            print("Ratings file rewritten, full run")
+            return 0
+        if any(output.mining or output.matrix or output.prune or
+          output.sampler for output in outputs):
+            print("Mining, matrix files, pruning and sampling need all the "
+              "transactions, full run")
+            return 0
+        for output in outputs:
+            entry = self.entry(output)
+            if entry is None or entry['format'] != output.format or \
+              entry.get('params') != output.params:
+                print("Output %s changed, full run" % output.filename)
+                return 0
+
+        for output in outputs:
+            output.resume(self.entry(output)['tid'])
+        return rating['size']
+
+    def save(self, inputs, caches, outputs, kept=()):
+        """Write the state of a finished run
+
+        outputs are the outputs written by the run, and kept the up to date
+        outputs, whose recorded state is kept.
+        """
+        entries = {}
+        for output in kept:
+            entries[output.filename] = self.entry(output)
+        for output in outputs:
+            if output.filename and os.path.isfile(output.filename):
+                entries[output.filename] = {
+                    'tid': output.transid,
+                    'size': os.path.getsize(output.filename),
+                    'format': output.format,
+                    'params': output.params,
+                    'key': output.key,
+                    }
+        self.state = {
+            'inputs': inputs,
+            'caches': caches,
+            'outputs': entries,
+            }
+        tmpFilename = self.filename + '.tmp'
+        fh = open(tmpFilename, 'w')
+        try:
+            json.dump(self.state, fh, indent=1, sort_keys=True)
+        finally:
+            fh.close()
+        os.rename(tmpFilename, self.filename)
+
+
+# Categorical attributes of the users stored as code columns in a snapshot
+SNAPSHOT_USER_FIELDS = ('sex', 'ageCat', 'profession', 'postcode', 'citi',
+  'state')
+
+
+class Snapshot:
+    """Binary snapshot of the loaded movies, users and ratings
+
+    The snapshot directory has:
+     * <column>.npy: the columns of the sorted RatingStore
+     * users.npy: the user ids and the codes of their categorical fields,
+        and userOrder.npy the positions of the ratings of every user
+     * movies.json: the movies, with the slices of their ratings
+     * meta.json: the layout version, the key, the string tables of the
+        user codes, the ids of the movies with IMDB information and the
+        manifest digests of the IMDB information and the user locations
+    The arrays are memory mapped when the snapshot is loaded. The key holds
+    the fingerprints of the inputs and of the IMDB and postcode cache
+    files, so a snapshot is only used while they do not change.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
 
+    def _path(self, name):
+        return os.path.join(self.directory, name)
 
+    def load(self, key):
+        """Return the (moviesDict, usersDict, ratingStore, caches, enriched)
+        of the snapshot, or None if there is no snapshot for key"""
+        try:
+            fh = open(self._path('meta.json'), 'r')
+            try:
+                meta = json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            return None
+        if meta.get('version') != SNAPSHOT_VERSION or meta.get('key') != key:
+            print("Snapshot out of date, loading the inputs")
+            return None
+
+        store = RatingStore(*[numpy.load(self._path(name + '.npy'),
+          mmap_mode='r') for name in RatingStore.COLUMNS])
+
+        fh = open(self._path('movies.json'), 'r')
+        try:
+            entries = json.load(fh)
+        finally:
+            fh.close()
+        moviesDict = {}
+        for entry in entries:
+            movie = Movie()
+            (movie.id, movie.name, imdbName, movie.year, movie.director,
+              movie.cast, movie.genre, movie.imdbRating, movie.tags, start,
+              stop) = entry
+            movie.id = str(movie.id)
+            movie.imdbName = imdbName.encode('latin-1')
+            movie.categorize()
+            if stop > start:
+                movie.rating = RatingList(store, slice(start, stop))
+            moviesDict[movie.id] = movie
+
+        # The codes of the snapshot are translated to the codes of this run
+        users = numpy.load(self._path('users.npy'), mmap_mode='r')
+        order = numpy.load(self._path('userOrder.npy'), mmap_mode='r')
+        columns = []
+        for field in SNAPSHOT_USER_FIELDS:
+            descriptor = getattr(User, field)
+            codes = numpy.array([descriptor.code(value)
+              for value in meta['tables'][field]], dtype=numpy.int32)
+            columns.append(codes[users[field]].tolist())
+        usersDict = {}
+        for i, userid in enumerate(users['id'].tolist()):
+            user = User()
+            user.id = str(userid)
+            (user._sex, user._ageCat, user._profession, user._postcode,
+              user._citi, user._state) = [column[i] for column in columns]
+            start = users['start'][i]
+            if users['stop'][i] > start:
+                user.rating = RatingList(store, order[start:users['stop'][i]])
+            usersDict[user.id] = user
+
+        enriched = set(str(movieid) for movieid in meta['enriched'])
+        return moviesDict, usersDict, store, meta['caches'], enriched
+
+    def save(self, key, moviesDict, usersDict, ratingStore, caches, enriched):
+        """Write the snapshot of the loaded movies, users and ratings
+
+        enriched are the ids of the movies with IMDB information."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # A snapshot being written is never valid
+        if os.path.isfile(self._path('meta.json')):
+            os.remove(self._path('meta.json'))
+        for name, column in zip(RatingStore.COLUMNS, ratingStore._columns()):
+            numpy.save(self._path(name + '.npy'), column)
+
+        entries = []
+        for movieid in sorted(moviesDict, key=int):
+            movie = moviesDict[movieid]
+            (start, stop) = (0, 0)
+            if movie.rating:
+                (start, stop) = (movie.rating.index.start,
+                  movie.rating.index.stop)
+            entries.append([movie.id, movie.name,
+              movie.imdbName.decode('latin-1'), movie.year, movie.director,
+              movie.cast, movie.genre, movie.imdbRating, movie.tags, start,
+              stop])
+        fh = open(self._path('movies.json'), 'w')
+        try:
+            json.dump(entries, fh)
+        finally:
+            fh.close()
+
+        userids = sorted(usersDict, key=int)
+        users = numpy.zeros(len(userids), dtype=[('id', numpy.int32),
+          ('start', numpy.int64), ('stop', numpy.int64)] +
+          [(field, numpy.int32) for field in SNAPSHOT_USER_FIELDS])
+        positions = []
+        start = 0
+        for i, userid in enumerate(userids):
+            user = usersDict[userid]
+            row = [int(userid), start, start + len(user.rating)]
+            row.extend(getattr(user, '_' + field)
+              for field in SNAPSHOT_USER_FIELDS)
+            users[i] = tuple(row)
+            if user.rating:
+                positions.append(user.rating.index)
+                start += len(user.rating)
+        numpy.save(self._path('users.npy'), users)
+        numpy.save(self._path('userOrder.npy'), numpy.concatenate(positions)
+          if positions else numpy.zeros(0, dtype=numpy.int32))
+
+        meta = {
+            'version': SNAPSHOT_VERSION,
+            'key': key,
+            'tables': dict((field, getattr(User, field).values)
+              for field in SNAPSHOT_USER_FIELDS),
+            'caches': caches,
+            'enriched': sorted(enriched, key=int),
+            }
+        tmpFilename = self._path('meta.json.tmp')
+        fh = open(tmpFilename, 'w')
+        try:
+            json.dump(meta, fh, sort_keys=True)
+        finally:
+            fh.close()
+        os.rename(tmpFilename, self._path('meta.json'))
 
 
+def output_key(output, inputs, caches):
+    """Return the hash of the parameters of an output and of the state of
+    the inputs and caches it is built from"""
+    return hashlib.sha1(json.dumps([output.params, inputs, caches],
+      sort_keys=True)).hexdigest()
 
 
-def main():
-    cmdArgs = parse_arguments()
+def snapshot_key(inputs, cacheFiles):
+    """Return the key of a snapshot: the fingerprints of the inputs and of
+    the cache files"""
+    key = dict(inputs)
+    for name, filename in cacheFiles.items():
+        key[name] = None
+        if filename and os.path.isfile(filename):
+            key[name] = file_fingerprint(filename)
+    return key
+
+
+def run(cmdArgs):
+    """Preprocess the datasets of a config section, return the exit code"""
     config = readYaml(cmdArgs.config)
     if not config:
         print("Error loading the config file %s" % cmdArgs.config)
@@ -1049,120 +3533,217 @@ def main():
       (config['input']['base_path'], config['input']['user'])
     ratingFile = "%s/%s" %  \
       (config['input']['base_path'], config['input']['rating'])
+    tagFile = None
+    if config['input'].get('tag'):
+        tagFile = "%s/%s" %  \
+          (config['input']['base_path'], config['input']['tag'])
     imdbFile = "%s/%s" %  \
       (config['output']['base_path'], config['output']['imdb'])
-    output1File = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['file1'])
-    outputFileLike1 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike1'])
-    outputFileLike2 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike2'])
-    outputFileLike3 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike3'])
-    outputFileLike4 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike4'])
-    outputFileLike5 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike5'])
-    outputFileLike6 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike6'])
-    outputFileLike7 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike7'])
-    outputFileLike8 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike8'])
-    outputFileLike9 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike9'])
-    outputFileLike10 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike10'])
-    outputFileLike11 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike11'])
-    outputFileLike12 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike12'])
-    outputFileLike13 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike13'])
-    outputLocationCitiMovie = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLocationCitiMovie'])
-    outputLocationStateMovie = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLocationStateMovie'])
-    outputLocationCitiGenre = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLocationCitiGenre'])
-    outputLocationStateGenre = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLocationStateGenre'])
-    outputFileLike2000 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike2000'])
-    outputFileLike2001 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike2001'])
-    outputFileLike2002 = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileLike2002'])
-    outputActors = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileActors'])
-    outputDirectors = "%s/%s" %  \
-      (config['output']['base_path'], config['output']['fileDirectors'])
-
-    # Load all movies
-    moviesDict = load_movies(movieFile)
-    # get extra info from IMDB    
-    get_extra_info_from_movies(moviesDict, imdbFile)
-
-#    # Get the genre list
-#    genreList = getGenreList(moviesDict)
-
-    # Load all the users
-    usersDict = load_users(userFile)
-    # Get the citi and state
-    for user in usersDict.values():
-        user.getCiti()
-
-    # Load rating
-    ratingSet = load_rating(ratingFile)
-    assign_rating(ratingSet, moviesDict, usersDict)
-
-##    writeOutputLikes1(outputFileLike1, moviesDict, usersDict)
-##    writeOutputLikes2(outputFileLike2, moviesDict, usersDict)
-##    writeOutputLikes3(outputFileLike3, moviesDict, usersDict)
-##    writeOutputLikes4(outputFileLike4, moviesDict, usersDict, genreList)
-##    writeOutputLikes5(outputFileLike5, moviesDict, usersDict)
-##    writeTransActorsDirectors(outputFileLike6, moviesDict, usersDict, ranking="high")
-##    writeTransDirectors(outputFileLike7, moviesDict, usersDict, ranking="high")
-##    writeTransActorsDirectors(outputFileLike8, moviesDict, usersDict, ranking="low")
-##    writeTransDirectors(outputFileLike9, moviesDict, usersDict, ranking="low")
-#    writeTransActorsDirectors(outputFileLike10, moviesDict, usersDict, 
-#      ranking=None, writeGenre=True)
-#    writeTransActorsDirectors(outputFileLike11, moviesDict, usersDict, 
-#      ranking=None, writeGenre=False)
-#    writeTransDirectors(outputFileLike12, moviesDict, usersDict, 
-#      ranking=None, writeGenre=True)
-#    writeTransDirectors(outputFileLike13, moviesDict, usersDict, 
-#      ranking=None, writeGenre=False)
-#    writeLocationMovie(outputLocationCitiMovie, moviesDict, usersDict, 
-#      ranking=None, citi=True, state=False, director=False )
-#    writeLocationMovie(outputLocationStateMovie, moviesDict, usersDict, 
-#      ranking=None, citi=False, state=True, director=True )
-#    writeLocationGenre(outputLocationCitiGenre, moviesDict, usersDict, 
-#      ranking=None, citi=True, state=False, director=False )
-#    writeLocationGenre(outputLocationStateGenre, moviesDict, usersDict, 
-#      ranking=None, citi=False, state=True, director=False )
-#    writeTransActorsDirectors(outputFileLike2000, moviesDict, usersDict, 
-#      ranking=None, writeGenre=False, ratingYear=(2000,))
-#    writeTransActorsDirectors(outputFileLike2001, moviesDict, usersDict, 
-#      ranking=None, writeGenre=False, ratingYear=(2001,))
-#    writeTransActorsDirectors(outputFileLike2002, moviesDict, usersDict, 
-#      ranking=None, writeGenre=False, ratingYear=range(2002,2015))
-#    writeOnlyActorsDirectors(outputDirectors, moviesDict, usersDict, 
-#      ranking=["high", "low"], actors=False, directors=True )
-#    writeOnlyActorsDirectors(outputActors, moviesDict, usersDict, 
-#      ranking=["high", "low"], actors=True, directors=False )
-#    writeTransActorsDirectors(outputFileLike2002, moviesDict, usersDict, 
-#      ranking=None, writeGenre=False, ratingYear=range(2002,2015))
-    alejo(outputFileLike2000, moviesDict, usersDict,
-        ranking=None, writeGenre=True, ratingYear=(2000,))
-    alejo(outputFileLike2001, moviesDict, usersDict,
-        ranking=None, writeGenre=True, ratingYear=(2001,))
-    alejo(outputFileLike2002, moviesDict, usersDict,
-        ranking=None, writeGenre=True, ratingYear=range(2002,2015))
+    itemsFile = "%s/%s" %  \
+      (config['output']['base_path'], config['output'].get('items', 'items.csv'))
+    manifestFile = "%s/%s" %  \
+      (config['output']['base_path'],
+      config['output'].get('manifest', 'manifest.json'))
+
+    # Every dataset of the config is written to an output
+    try:
+        outputs = dataset_outputs(config.get('datasets') or {},
+          config['output']['base_path'],
+          config['output'].get('format', 'labels'), config.get('mining'),
+          config['output'].get('compression'))
+    except (ValueError, KeyError, TypeError) as e:
+        print("Error in the datasets of the config file: %s" % e)
+        return 1
+    if not outputs:
+        print("No dataset enabled in the config file")
+        return 1
+
+    # The shelve cache of older versions is converted once
+    if not migrate_imdb_cache(imdbFile):
+        return 1
+
+    postcodeFile = None
+    if config['output'].get('postcode'):
+        postcodeFile = "%s/%s" %  \
+          (config['output']['base_path'], config['output']['postcode'])
+    tagsConfig = config.get('tags') or {}
+
+    # State of the inputs, recorded in the manifest
+    with metrics.stage('fingerprints'):
+        inputs = {
+            'movie': file_fingerprint(movieFile),
+            'user': file_fingerprint(userFile),
+            }
+        # A compressed ratings file is always read whole
+        compression = compression_of(ratingFile)
+        if compression:
+            inputs['rating'] = file_fingerprint(ratingFile)
+            inputs['rating']['compression'] = compression
+        else:
+            inputs['rating'] = file_fingerprint(ratingFile,
+              complete_size(ratingFile))
+        if tagFile:
+            inputs['tag'] = dict(file_fingerprint(tagFile), params=tagsConfig)
+
+    # The loaded state of a previous run with the same inputs
+    snapshot = None
+    state = None
+    cacheFiles = {'imdbCache': imdbFile, 'postcodeCache': postcodeFile}
+    if config['output'].get('snapshot'):
+        snapshot = Snapshot("%s/%s" % (config['output']['base_path'],
+          config['output']['snapshot']))
+        if not cmdArgs.incremental:
+            with metrics.stage('load_snapshot'):
+                state = snapshot.load(snapshot_key(inputs, cacheFiles))
+    if state:
+        (moviesDict, usersDict, ratingStore, caches, enriched) = state
+        print("Snapshot of %d ratings loaded" % len(ratingStore))
+    else:
+        # Load all movies, the IMDB information is added once the ratings
+        # tell which movies reach the outputs
+        with metrics.stage('load_movies'):
+            moviesDict = load_movies(movieFile)
+        if moviesDict is None:
+            return 1
+        enriched = set()
+
+        # Tags of the movies, pruned while they are counted
+        if tagFile:
+            with metrics.stage('load_tags'):
+                ntags = load_tags(tagFile, moviesDict,
+                  minFreq=tagsConfig.get('minFreq', 1),
+                  top=tagsConfig.get('top'),
+                  capacity=tagsConfig.get('capacity', TAG_CAPACITY))
+            if ntags is None:
+                return 1
+            print("%d movie tags loaded" % ntags)
+
+#        # Get the genre list
+#        genreList = getGenreList(moviesDict)
+
+        # Load all the users
+        with metrics.stage('load_users'):
+            usersDict = load_users(userFile)
+        if usersDict is None:
+            return 1
+        # Get the citi and state
+        with metrics.stage('resolve_user_cities'):
+            resolve_user_cities(usersDict, PostcodeResolver(postcodeFile))
+
+        with metrics.stage('digests'):
+            caches = {
+                'imdb': movies_digest(moviesDict, ImdbCache(imdbFile)),
+                'postcode': users_digest(usersDict),
+                }
+
+    # Skip the outputs built from the same parameters and inputs
+    manifest = Manifest(manifestFile)
+    kept = []
+    for output in outputs:
+        output.key = output_key(output, inputs, caches)
+        if not cmdArgs.force and manifest.upToDate(output):
+            print("%s is up to date" % output.filename)
+            kept.append(output)
+    outputs = [output for output in outputs if output not in kept]
+    if not outputs:
+        print("All the datasets are up to date")
+        return 0
+
+    # Load only the new ratings when the outputs can be resumed
+    offset = 0
+    if cmdArgs.incremental and not cmdArgs.force:
+        offset = manifest.resume(inputs, caches, ratingFile, outputs)
+    # The ids of the outputs that are not rewritten must not change
+    itemDictionary = ItemDictionary()
+    if (offset or kept) and os.path.isfile(itemsFile):
+        itemDictionary.read(itemsFile)
+    if not state:
+        with metrics.stage('load_rating'):
+            ratingStore = load_rating(ratingFile, offset,
+              None if compression else inputs['rating']['size'])
+        if ratingStore is None:
+            return 1
+        print("%d ratings loaded from offset %d" % (len(ratingStore), offset))
+        with metrics.stage('assign_rating'):
+            assign_rating(ratingStore, moviesDict, usersDict)
+
+    # get extra info from IMDB, only for the movies that reach the outputs
+    imdbConfig = config.get('imdb') or {}
+    dumps = None
+    if imdbConfig.get('dumps'):
+        dumps = os.path.join(config['input']['base_path'], imdbConfig['dumps'])
+    with metrics.stage('get_extra_info_from_movies'):
+        movies = dict((movie.id, movie) for movie in
+          referenced_movies(outputs, moviesDict) if movie.id not in enriched)
+        try:
+            queried = get_extra_info_from_movies(movies, imdbFile,
+              workers=imdbConfig.get('workers', 1),
+              rate=imdbConfig.get('rate'),
+              retries=imdbConfig.get('retries', 0),
+              backoff=imdbConfig.get('backoff', 1.0),
+              url=imdbConfig.get('url'),
+              dumps=dumps)
+        except (IOError, ValueError) as e:
+            print("Error reading the IMDB information: %s" % e)
+            return 1
+        enriched.update(movies)
+    print("%d movies enriched" % len(movies))
+    # The new IMDB entries are part of the state of the written outputs
+    if queried:
+        caches['imdb'] = movies_digest(moviesDict, ImdbCache(imdbFile))
+        for output in outputs:
+            output.key = output_key(output, inputs, caches)
+
+    # Only the state of all the ratings is saved
+    if snapshot and not state and not offset:
+        with metrics.stage('save_snapshot'):
+            snapshot.save(snapshot_key(inputs, cacheFiles), moviesDict,
+              usersDict, ratingStore, caches, enriched)
+
+    # All the outputs are written in a single pass over the ratings
+    with metrics.stage('write_transactions'):
+        if cmdArgs.cprofile:
+            # The shard processes are profiled apart and merged with this one
+            shardsProfile = cmdArgs.cprofile + '.shards'
+            if os.path.isfile(shardsProfile):
+                os.remove(shardsProfile)
+            profiler = cProfile.Profile()
+            written = profiler.runcall(write_transactions, outputs,
+              moviesDict, usersDict, itemsFile=itemsFile,
+              itemDictionary=itemDictionary, workers=cmdArgs.workers,
+              profile=shardsProfile)
+            stats = pstats.Stats(profiler)
+            if os.path.isfile(shardsProfile):
+                stats.add(shardsProfile)
+                os.remove(shardsProfile)
+            stats.dump_stats(cmdArgs.cprofile)
+        else:
+            written = write_transactions(outputs, moviesDict, usersDict,
+              itemsFile=itemsFile, itemDictionary=itemDictionary,
+              workers=cmdArgs.workers)
+    # The outputs that could not be opened are rebuilt by the next run
+    manifest.save(inputs, caches, written, kept)
+    if len(written) < len(outputs):
+        print("%d datasets could not be written" %
+          (len(outputs) - len(written)))
+        return 1
 
     return 0
 
 
+def main():
+    cmdArgs = parse_arguments()
+    if cmdArgs.trace_memory:
+        metrics.startTracing()
+
+    status = run(cmdArgs)
+    if cmdArgs.profile:
+        metrics.write(cmdArgs.profile)
+        print("Metrics written to %s" % cmdArgs.profile)
+
+    return status
+
+
 if __name__ == "__main__":
     exit(main())
     
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+import argparse
+import array
+import itertools
+import os
+import time
+
+import numpy
+
+import miner
+import preprocess
+
+# Default grid: the minsup range of the report
+MINSUPS = ['0.009:0.03:0.003']
+MINCONFS = ['0.1']
+# Rules of every grid point written to the top rules file
+TOP_RULES = 10
+
+
+def parse_grid(values):
+    """Return the sorted values of a grid axis
+
+    Every value is a number or a first:last:step range, last included.
+    """
+    grid = set()
+    for value in values:
+        if ':' in value:
+            (first, last, step) = [float(number) for number in value.split(':')]
+            count = int(round((last - first) / step)) + 1
+            grid.update(round(first + i * step, 10) for i in range(count))
+        else:
+            grid.add(float(value))
+    return sorted(grid)
+
+
+def read_transactions(filename, itemsFile=None):
+    """Return the TransactionSet and the item labels of a transactions file
+
+    The file is written by preprocess.py, in labels or ids format and maybe
+    compressed. The ids format needs the items file of its run, items.csv
+    next to the file by default.
+    """
+    labels = preprocess.ItemDictionary()
+    ids = None
+    fh = preprocess.open_input(filename)
+    try:
+        header = fh.readline().strip()
+        if header == 'tid,itemid':
+            if itemsFile is None:
+                itemsFile = os.path.join(os.path.dirname(filename),
+                  'items.csv')
+            labels.read(itemsFile)
+        elif header == 'tid,pid':
+            ids = {}
+        else:
+            raise ValueError("%s is not a transactions file" % filename)
+
+        items = array.array('i')
+        lengths = array.array('i')
+        lastTid = None
+        for line in fh:
+            (tid, item) = line.rstrip('\n').split(',', 1)
+            if ids is None:
+                itemid = int(item)
+            else:
+                # The labels are decoded once
+                itemid = ids.get(item)
+                if itemid is None:
+                    itemid = ids[item] = labels.id(item[1:-1].decode('utf-8'))
+            if tid != lastTid:
+                lengths.append(0)
+                lastTid = tid
+            lengths[-1] += 1
+            items.append(itemid)
+    finally:
+        fh.close()
+
+    transactions = miner.TransactionSet()
+    transactions.extend(items, lengths)
+    return transactions, labels
+
+
+def sweep(transactions, minsups, minconfs, minlifts, maxlen=miner.MAXLEN):
+    """Return the itemsets and the rules of every point of a grid
+
+    The frequent itemsets are mined once at the lowest minsup and the rules
+    generated once at the lowest thresholds. The rules of a point are the
+    ones above its thresholds, as generate_rules tests them, so they are
+    the rules a mining run with the point thresholds returns, in the same
+    order. Returns the list of rules and a list of (minsup, minconf,
+    minlift, itemsets, positions) with the number of frequent itemsets and
+    the positions of the rules of every point. A None minlift does not
+    filter by lift.
+    """
+    ntrans = len(transactions)
+    itemsets = miner.frequent_itemsets(transactions, min(minsups), maxlen)
+    minlift = None if None in minlifts else min(minlifts)
+    rules = miner.generate_rules(itemsets, ntrans, min(minconfs), minlift)
+
+    itemsetCounts = numpy.array(list(itemsets.values()), dtype=numpy.int64)
+    ruleCounts = numpy.array([int(round(rule[2] * ntrans)) for rule in rules],
+      dtype=numpy.int64)
+    confidences = numpy.array([rule[3] for rule in rules])
+    lifts = numpy.array([rule[4] for rule in rules])
+
+    points = []
+    for (minsup, minconf, minlift) in itertools.product(minsups, minconfs,
+      minlifts):
+        minCount = max(1, int(numpy.ceil(minsup * ntrans - 1e-9)))
+        selected = (ruleCounts >= minCount) & (confidences >= minconf)
+        if minlift is not None:
+            selected &= lifts >= minlift
+        points.append((minsup, minconf, minlift,
+          int((itemsetCounts >= minCount).sum()), numpy.flatnonzero(selected)))
+    return rules, points
+
+
+def write_sweep(prefix, rules, points, labels, top=TOP_RULES):
+    """Write the summary of the grid points and their top rules by lift
+
+    <prefix>.csv has the number of frequent itemsets and rules of every
+    point, <prefix>.top.csv the top rules of every point in the format of
+    the arules write function.
+    """
+    fh = open(prefix + '.csv', 'w')
+    try:
+        fh.write('"minsup","minconf","minlift","itemsets","rules"\n')
+        for (minsup, minconf, minlift, itemsets, positions) in points:
+            fh.write('%g,%g,%s,%d,%d\n' % (minsup, minconf,
+              'NA' if minlift is None else '%g' % minlift, itemsets,
+              len(positions)))
+    finally:
+        fh.close()
+
+    fh = open(prefix + '.top.csv', 'w')
+    try:
+        fh.write('"minsup","minconf","minlift","rank","rules","support",'
+          '"confidence","lift"\n')
+        for (minsup, minconf, minlift, itemsets, positions) in points:
+            for rank, position in enumerate(positions[:top].tolist(), 1):
+                rule = rules[position]
+                line = u'%g,%g,%s,%d,"%s",%.6f,%.6f,%.6f\n' % (minsup,
+                  minconf, 'NA' if minlift is None else '%g' % minlift, rank,
+                  miner.format_rule(rule, labels), rule[2], rule[3], rule[4])
+                fh.write(line.encode('utf-8'))
+    finally:
+        fh.close()
+
+
+def parse_arguments():
+    """ Function that parse main command line parameters
+
+    Returns:
+        * ok: argparse object
+        * fail: argparse will exit
+    """
+    argParser = argparse.ArgumentParser(
+        description='Mine the rules of a transactions file for a grid of '
+          'thresholds, mining the itemsets only once')
+    argParser.add_argument('transactions',
+        help='Transactions file written by preprocess.py')
+    argParser.add_argument('--items',
+        help='Items file of an ids transactions file, items.csv next to it '
+          'by default')
+    argParser.add_argument('--minsup', nargs='+', default=MINSUPS,
+        help='Minimum supports, numbers or first:last:step ranges')
+    argParser.add_argument('--minconf', nargs='+', default=MINCONFS,
+        help='Minimum confidences, numbers or first:last:step ranges')
+    argParser.add_argument('--minlift', nargs='+',
+        help='Minimum lifts, numbers or first:last:step ranges')
+    argParser.add_argument('--maxlen', type=int, default=miner.MAXLEN)
+    argParser.add_argument('--top', type=int, default=TOP_RULES,
+        help='Rules by lift written for every point')
+    argParser.add_argument('--output',
+        help='Prefix of the summary files, the transactions file without '
+          'its extensions plus .sweep by default')
+
+    args = argParser.parse_args()
+
+    return args
+
+
+def main():
+    cmdArgs = parse_arguments()
+
+    try:
+        minsups = parse_grid(cmdArgs.minsup)
+        minconfs = parse_grid(cmdArgs.minconf)
+        minlifts = parse_grid(cmdArgs.minlift) if cmdArgs.minlift else [None]
+    except ValueError as e:
+        print("Wrong grid: %s" % e)
+        return 1
+    prefix = cmdArgs.output
+    if prefix is None:
+        prefix = cmdArgs.transactions
+        for extension in ('.gz', '.xz', '.csv'):
+            if prefix.endswith(extension):
+                prefix = prefix[:-len(extension)]
+        prefix += '.sweep'
+
+    start = time.time()
+    try:
+        (transactions, labels) = read_transactions(cmdArgs.transactions,
+          cmdArgs.items)
+    except (IOError, ValueError) as e:
+        print("Error reading %s: %s" % (cmdArgs.transactions, e))
+        return 1
+    print("%d transactions read in %.2fs" % (len(transactions),
+      time.time() - start))
+
+    start = time.time()
+    (rules, points) = sweep(transactions, minsups, minconfs, minlifts,
+      cmdArgs.maxlen)
+    print("%d points swept in %.2fs" % (len(points), time.time() - start))
+    for (minsup, minconf, minlift, itemsets, positions) in points:
+        print("minsup %g minconf %g minlift %s: %d itemsets, %d rules" %
+          (minsup, minconf, 'NA' if minlift is None else '%g' % minlift,
+          itemsets, len(positions)))
+
+    write_sweep(prefix, rules, points, labels, cmdArgs.top)
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,58 @@
+"""Tests of the items of the dataset specs"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import preprocess
+
+
+def make_movie(director=None, year=None):
+    movie = preprocess.Movie()
+    movie.id = '1'
+    movie.name = u'Heat'
+    movie.director = director
+    movie.year = year
+    movie.categorize()
+    return movie
+
+
+def make_user(citi=None, state=None):
+    user = preprocess.User()
+    user.id = '1'
+    user.sex = 'male'
+    user.citi = citi
+    user.state = state
+    return user
+
+
+class DatasetItemsTest(unittest.TestCase):
+
+    def items(self, spec, movie, user):
+        output = preprocess.datasetOutput('unused.csv', spec)
+        (head, tail) = output.movieItems(movie)
+        return head, output.userItems(user)
+
+    def test_user_without_city(self):
+        spec = {'head': ['name'], 'user': ['sex', 'citi', 'state']}
+        self.assertEqual(self.items(spec, make_movie(), make_user())[1],
+          [u'male', u'None', u'None'])
+        self.assertEqual(self.items(spec, make_movie(),
+          make_user(u'Chicago', u'IL'))[1], [u'male', u'Chicago', u'IL'])
+
+    def test_missing_movie_fields(self):
+        spec = {'head': ['name', 'yearCat', 'director']}
+        self.assertEqual(self.items(spec, make_movie(), make_user())[0],
+          [u'Heat'])
+        self.assertEqual(self.items(dict(spec, missing='None'), make_movie(),
+          make_user())[0], [u'Heat', u'None', u'director_None'])
+        self.assertEqual(self.items(dict(spec, missing='None'),
+          make_movie(u'Michael Mann', 1995), make_user())[0],
+          [u'Heat', u'1990', u'director_Michael Mann'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: set expandtab ts=4 sw=4:
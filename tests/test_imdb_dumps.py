@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Tests of the enrichment from the IMDB dataset dumps"""
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import preprocess
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'imdb')
+
+# MovieLens names of the movies, in the latin-1 of the movies file
+NAMES = {
+    '1': u'Toy Story (1995)',
+    '2': u'American President, The (1995)',
+    '3': u'City of Lost Children, The (Cité des enfants perdus, La) (1995)',
+    '4': u'Heat (1995)',
+    '5': u"Amelie (Fabuleux destin d'Amélie Poulain, Le) (2002)",
+    '6': u'Sabrina (1995)',
+    '7': u'Casino (1995)',
+    '8': u'Nothing Here (1995)',
+    }
+
+
+class ImdbDumpsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dumps = os.path.join(self.directory, 'dumps')
+        shutil.copytree(FIXTURES, self.dumps)
+        self.cacheFile = os.path.join(self.directory, 'imdb_cache.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def enrich(self, queried=len(NAMES)):
+        movies = {}
+        for movieid, name in NAMES.items():
+            movie = preprocess.Movie()
+            movie.id = movieid
+            movie.imdbName = name.encode('latin-1')
+            movies[movieid] = movie
+        self.assertEqual(preprocess.get_extra_info_from_movies(movies,
+          self.cacheFile, dumps=self.dumps), queried)
+        return movies
+
+    def test_movielens_titles(self):
+        self.assertEqual(preprocess.movielens_titles(
+          u'City of Lost Children, The (Cité des enfants perdus, La) (1995)'),
+          ([u'the city of lost children', u'la cite des enfants perdus'],
+          1995))
+        self.assertEqual(preprocess.movielens_titles(u"L'Argent, L' (1983)"),
+          ([u'l l argent'], 1983))
+        self.assertEqual(preprocess.movielens_titles(u'No year'), ([], None))
+
+    def test_match(self):
+        movies = self.enrich()
+        toyStory = movies['1']
+        self.assertEqual(toyStory.name, u'Toy Story')
+        self.assertEqual(toyStory.year, 1995)
+        self.assertEqual(toyStory.yearCat, u'1990')
+        self.assertEqual(toyStory.director, u'John Lasseter')
+        # The cast in ordering, without the other principals
+        self.assertEqual(toyStory.cast, [u'Tom Hanks', u'Tim Allen'])
+        self.assertEqual(toyStory.imdbRating, 8.3)
+        # Articles and alternate titles
+        self.assertEqual(movies['2'].name, u'The American President')
+        self.assertEqual(movies['2'].cast,
+          [u'Actor %d' % i for i in range(1, preprocess.CAST_SIZE + 1)])
+        self.assertEqual(movies['3'].name, u'The City of Lost Children')
+        self.assertEqual(movies['3'].director, None)
+        self.assertEqual(movies['3'].cast, None)
+        # Not found
+        self.assertEqual(movies['8'].name, None)
+        self.assertEqual(movies['8'].imdbRating, None)
+
+    def test_off_by_one_year(self):
+        movies = self.enrich()
+        self.assertEqual(movies['5'].name, u'Amélie')
+        self.assertEqual(movies['5'].year, 2001)
+        self.assertEqual(movies['5'].cast, [u'Audrey Tautou'])
+        self.assertEqual(movies['7'].director, u'Martin Scorsese')
+        self.assertEqual(movies['7'].year, 1994)
+
+    def test_preferences(self):
+        movies = self.enrich()
+        # A movie before a short with more votes, and before a TV movie
+        self.assertEqual(movies['4'].director, u'Michael Mann')
+        self.assertEqual(movies['2'].imdbRating, 6.8)
+        # Between two movies, the one with more votes
+        self.assertEqual(movies['6'].imdbRating, 7.7)
+
+    def test_cached(self):
+        self.enrich()
+        cache = preprocess.ImdbCache(self.cacheFile)
+        self.assertEqual(len(cache), len(NAMES))
+        self.assertEqual(cache['4'].director, u'Michael Mann')
+        self.assertEqual(cache['8'].name, None)
+        # The next run reads the cache, not the dumps
+        shutil.rmtree(self.dumps)
+        movies = self.enrich(queried=0)
+        self.assertEqual(movies['1'].cast, [u'Tom Hanks', u'Tim Allen'])
+
+    def test_gzip_before_tsv(self):
+        # A gzipped dump is read instead of the plain one next to it
+        filename = os.path.join(self.dumps, 'title.ratings.tsv')
+        fh = gzip.open(filename + '.gz', 'wb')
+        try:
+            for line in open(filename):
+                if line.startswith('tt0000001\t'):
+                    line = 'tt0000001\t9.9\t900\n'
+                fh.write(line)
+        finally:
+            fh.close()
+        movies = self.enrich()
+        self.assertEqual(movies['1'].imdbRating, 9.9)
+
+    def test_missing_dump(self):
+        os.remove(os.path.join(self.dumps, 'title.crew.tsv'))
+        self.assertRaises(IOError, self.enrich)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: set expandtab ts=4 sw=4:
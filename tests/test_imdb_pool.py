@@ -0,0 +1,233 @@
+"""Tests of the IMDB enrichment pool against a local stub of IMDB"""
+import BaseHTTPServer
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import preprocess
+
+# The stub errors are expected, the client logs them
+logging.getLogger('imdbpy').setLevel(logging.CRITICAL + 1)
+
+SEARCH_PAGE = '''<html><head><title>Find - IMDb</title></head><body>
+<table class="findList"><tr class="findResult odd"><td class="primary_photo">
+</td><td class="result_text"> <a href="/title/tt%(id)s/?ref_=fn_tt_tt_1" >
+%(title)s</a> (%(year)d) </td></tr></table>
+</body></html>'''
+EMPTY_SEARCH_PAGE = '''<html><head><title>Find - IMDb</title></head><body>
+<table class="findList"></table></body></html>'''
+MOVIE_PAGE = '''<html><head><title>%(title)s (%(year)d)</title></head><body>
+<div id="tn15title"><h1>%(title)s <span>(<a href="/year/%(year)d/">%(year)d</a>)
+</span></h1></div>
+<div class="info"><h5>Director:</h5><div class="info-content">
+<a href="/name/nm0000001/">%(director)s</a><br/></div></div>
+<div class="starbar-meta"><b>%(rating).1f/10</b></div>
+<table class="cast"><tr class="odd"><td class="hs"></td><td class="nm">
+<a href="/name/nm0000002/">%(actor)s</a></td><td class="ddd"> ... </td>
+<td class="char">Himself</td></tr></table>
+</body></html>'''
+
+# IMDB id -> movie of the stub
+MOVIES = {
+    '0000001': {'title': u'Toy Story', 'year': 1995,
+      'director': u'John Lasseter', 'actor': u'Tom Hanks', 'rating': 8.3},
+    '0000002': {'title': u'Heat', 'year': 1995,
+      'director': u'Michael Mann', 'actor': u'Al Pacino', 'rating': 8.2},
+    '0000003': {'title': u'Casino', 'year': 1995,
+      'director': u'Martin Scorsese', 'actor': u'Robert De Niro',
+      'rating': 8.2},
+    }
+
+
+class ImdbStub(BaseHTTPServer.HTTPServer):
+    """IMDB stand-in server
+
+    failures maps a page ('search' or 'movie') and an IMDB id to the number
+    of requests that fail with a 503 before the page is served, -1 for
+    always. requests records the (time, page, id) of every request.
+    """
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+          ImdbStubHandler)
+        self.failures = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_port
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def fails(self, page, imdbID):
+        with self.lock:
+            self.requests.append((time.time(), page, imdbID))
+            left = self.failures.get((page, imdbID), 0)
+            if left > 0:
+                self.failures[(page, imdbID)] = left - 1
+            return left != 0
+
+    def count(self, page, imdbID=None):
+        return len([request for request in self.requests
+          if request[1] == page and imdbID in (None, request[2])])
+
+
+class ImdbStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path.startswith('/find'):
+            query = urlparse.parse_qs(url.query)['q'][0].decode('utf-8')
+            found = [(imdbID, movie) for imdbID, movie in MOVIES.items()
+              if u'%s (%d)' % (movie['title'], movie['year']) == query]
+            imdbID = found[0][0] if found else None
+            page = 'search'
+            if found:
+                body = SEARCH_PAGE % dict(found[0][1], id=imdbID)
+            else:
+                body = EMPTY_SEARCH_PAGE
+        elif url.path.endswith('/combined'):
+            imdbID = url.path.split('/')[2][2:]
+            page = 'movie'
+            body = MOVIE_PAGE % MOVIES[imdbID]
+        else:
+            # Plot and other secondary pages
+            imdbID = None
+            page = 'other'
+            body = EMPTY_SEARCH_PAGE
+        if self.server.fails(page, imdbID):
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+def make_movies(names):
+    movies = {}
+    for movieid, name in enumerate(names, 1):
+        movie = preprocess.Movie()
+        movie.id = str(movieid)
+        movie.imdbName = name
+        movies[movie.id] = movie
+    return movies
+
+
+class ImdbPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = ImdbStub()
+        self.directory = tempfile.mkdtemp()
+        self.cacheFile = os.path.join(self.directory, 'imdb_cache.jsonl')
+
+    def tearDown(self):
+        self.stub.stop()
+        shutil.rmtree(self.directory)
+
+    def enrich(self, names, **kwargs):
+        movies = make_movies(names)
+        kwargs.setdefault('workers', 2)
+        preprocess.get_extra_info_from_movies(movies, self.cacheFile,
+          url=self.stub.url, **kwargs)
+        return movies
+
+    def test_enrich(self):
+        movies = self.enrich(['Toy Story (1995)', 'Unknown (1995)'])
+        self.assertEqual(movies['1'].name, u'Toy Story')
+        self.assertEqual(movies['1'].year, 1995)
+        self.assertEqual(movies['1'].director, u'John Lasseter')
+        self.assertEqual(movies['1'].cast, [u'Tom Hanks'])
+        self.assertEqual(movies['1'].imdbRating, 8.3)
+        # A movie not found is cached, as its answer is final
+        cache = preprocess.ImdbCache(self.cacheFile)
+        self.assertEqual(cache['1'].director, u'John Lasseter')
+        self.assertEqual(cache['2'].name, None)
+
+    def test_retry(self):
+        self.stub.failures[('search', '0000001')] = 1
+        self.stub.failures[('movie', '0000001')] = 2
+        movies = self.enrich(['Toy Story (1995)'], retries=2, backoff=0.01)
+        self.assertEqual(movies['1'].director, u'John Lasseter')
+        self.assertEqual(self.stub.count('search', '0000001'), 2)
+        self.assertEqual(self.stub.count('movie', '0000001'), 3)
+
+    def test_failed_movie_not_cached(self):
+        self.stub.failures[('movie', '0000002')] = -1
+        movies = self.enrich(['Toy Story (1995)', 'Heat (1995)'], retries=1,
+          backoff=0.01)
+        self.assertEqual(movies['2'].name, None)
+        self.assertEqual(self.stub.count('movie', '0000002'), 2)
+        cache = preprocess.ImdbCache(self.cacheFile)
+        self.assertTrue('1' in cache)
+        self.assertFalse('2' in cache)
+
+    def test_rate_limit(self):
+        rate = 20.0
+        self.enrich(['Toy Story (1995)', 'Heat (1995)', 'Casino (1995)'],
+          workers=3, rate=rate)
+        times = sorted(request[0] for request in self.stub.requests
+          if request[1] in ('search', 'movie'))
+        self.assertEqual(len(times), 6)
+        # Every search and get_movie waits for its slot, shared by all the
+        # workers
+        self.assertTrue(times[-1] - times[0] >= (len(times) - 1) / rate * 0.9)
+
+    def test_resume(self):
+        names = ['Toy Story (1995)', 'Heat (1995)', 'Casino (1995)']
+        self.stub.failures[('search', '0000003')] = -1
+        self.enrich(names)
+        self.assertEqual(len(preprocess.ImdbCache(self.cacheFile)), 2)
+
+        # The next run only queries the movie missing from the cache
+        self.stub.failures = {}
+        self.stub.requests = []
+        movies = self.enrich(names)
+        self.assertEqual(self.stub.count('search'), 1)
+        self.assertEqual(self.stub.count('search', '0000003'), 1)
+        self.assertEqual(movies['1'].director, u'John Lasseter')
+        self.assertEqual(movies['3'].director, u'Martin Scorsese')
+        self.assertEqual(len(preprocess.ImdbCache(self.cacheFile)), 3)
+
+    def test_bad_client(self):
+        movies = make_movies(['Toy Story (1995)', 'Heat (1995)',
+          'Casino (1995)'])
+        cache = preprocess.ImdbCache(self.cacheFile)
+        done = []
+
+        def query():
+            preprocess.query_imdb_movies(movies.values(), cache, 2,
+              url=self.stub.url, clientArgs={'accessSystem': 'nowhere'})
+            done.append(True)
+
+        # The workers can not create their client: the pool must not hang
+        thread = threading.Thread(target=query)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertEqual(done, [True])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(self.stub.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: set expandtab ts=4 sw=4:
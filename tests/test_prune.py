@@ -0,0 +1,77 @@
+"""Tests of the support-based pruning of the transaction items"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import preprocess
+
+# movieid -> director, and the (userid, movieid) of the ratings
+DIRECTORS = {'1': u'Michael Mann', '2': u'Martin Scorsese'}
+RATINGS = [(1, 1), (2, 1), (3, 1), (1, 2)]
+
+
+def make_data():
+    movies = {}
+    for movieid, director in DIRECTORS.items():
+        movie = preprocess.Movie()
+        movie.id = movieid
+        movie.name = u'Movie %s' % movieid
+        movie.director = director
+        movie.imdbRating = 7.0
+        movies[movieid] = movie
+    users = {}
+    for userid in set(str(userid) for (userid, movieid) in RATINGS):
+        user = preprocess.User()
+        user.id = userid
+        users[userid] = user
+    store = preprocess.RatingStore([userid for (userid, movieid) in RATINGS],
+      [movieid for (userid, movieid) in RATINGS], [5.0] * len(RATINGS),
+      range(978300000, 978300000 + len(RATINGS)))
+    preprocess.assign_rating(store, movies, users)
+    return movies, users
+
+
+class PruneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'p_dir.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, workers=1):
+        (movies, users) = make_data()
+        output = preprocess.datasetOutput(self.filename, {'head': ['director'],
+          'ratingItem': False, 'prune': 0.5})
+        preprocess.write_transactions([output], movies, users,
+          workers=workers)
+        return open(self.filename).read().splitlines()
+
+    def test_empty_transaction_not_written(self):
+        # Scorsese is in 1 of the 4 transactions, below the minsup, so the
+        # transaction of movie 2 loses all its items
+        lines = self.write()
+        self.assertEqual(lines[1:], ['1,"director_Michael Mann"',
+          '2,"director_Michael Mann"', '3,"director_Michael Mann"'])
+        stats = json.load(open(self.filename + '.prune.json'))
+        self.assertEqual(stats['transactions'], 4)
+        self.assertEqual(stats['keptItems'], 1)
+        self.assertEqual(stats['emptyTransactions'], 1)
+
+    def test_sharded(self):
+        serial = self.write()
+        self.assertEqual(self.write(workers=2), serial)
+        stats = json.load(open(self.filename + '.prune.json'))
+        self.assertEqual(stats['emptyTransactions'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: set expandtab ts=4 sw=4:
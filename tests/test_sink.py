@@ -0,0 +1,71 @@
+"""Tests of the write errors of the transaction outputs"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import preprocess
+
+FULL = '/dev/full'
+
+
+def make_data():
+    movies = {}
+    for movieid in ('1', '2'):
+        movie = preprocess.Movie()
+        movie.id = movieid
+        movie.name = u'Movie %s' % movieid
+        movie.imdbRating = 7.0
+        movies[movieid] = movie
+    users = {}
+    for userid in ('1', '2'):
+        user = preprocess.User()
+        user.id = userid
+        user.sex = 'female'
+        users[userid] = user
+    store = preprocess.RatingStore([1, 2, 1], [1, 1, 2], [5.0, 1.0, 3.0],
+      [978300000, 978300001, 978300002])
+    preprocess.assign_rating(store, movies, users)
+    return movies, users
+
+
+class WriteErrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check(self, filename, workers):
+        (movies, users) = make_data()
+        spec = {'head': ['name'], 'user': ['sex']}
+        good = preprocess.datasetOutput(os.path.join(self.directory,
+          'good.csv'), spec)
+        bad = preprocess.datasetOutput(filename, spec)
+        # The error is reported instead of raised
+        written = preprocess.write_transactions([good, bad], movies, users,
+          workers=workers)
+        self.assertEqual(written, [good])
+        self.assertEqual(len(open(good.filename).read().splitlines()), 10)
+
+    @unittest.skipUnless(os.path.exists(FULL), "needs %s" % FULL)
+    def test_full_disk(self):
+        self.check(FULL, 1)
+
+    def test_shard_not_written(self):
+        filename = os.path.join(self.directory, 'bad.csv')
+        os.mkdir(preprocess._shard_filename(preprocess.TransactionOutput(
+          filename, None, None), 0))
+        self.check(filename, 2)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+          ['bad.csv', 'bad.csv.shard000', 'good.csv'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: set expandtab ts=4 sw=4:
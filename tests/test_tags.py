@@ -0,0 +1,41 @@
+"""Tests of the tags counting"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bin'))
+import preprocess
+
+
+class TagCounterTest(unittest.TestCase):
+
+    def count(self, tags, capacity):
+        counter = preprocess.TagCounter(capacity)
+        for tag in tags:
+            counter.add(tag)
+        return counter
+
+    def test_exact_below_capacity(self):
+        counter = self.count(['a', 'b', 'a', 'c', 'a', 'b'], 3)
+        self.assertEqual(counter.top(), ['a', 'b', 'c'])
+        self.assertEqual(counter.top(minFreq=2), ['a', 'b'])
+        self.assertEqual(counter.top(top=1), ['a'])
+
+    def test_evicted_tags_are_not_overcounted(self):
+        # c and d replace b and c with counts 2 and 3, but were used once
+        counter = self.count(['a', 'a', 'a', 'b', 'c', 'd'], 2)
+        self.assertEqual(counter.counts['d'], 3)
+        self.assertEqual(counter.top(minFreq=2), ['a'])
+        self.assertEqual(counter.top(), ['a', 'd'])
+
+    def test_frequent_tags_are_kept(self):
+        tags = ['x%d' % i for i in range(20)]
+        counter = self.count(tags[:10] + ['a'] * 10 + tags[10:], 4)
+        self.assertEqual(counter.top(minFreq=5), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: set expandtab ts=4 sw=4: